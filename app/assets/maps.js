@@ -0,0 +1,49 @@
+// Clientside callbacks for the two choropleths. The server ships the per state means once per
+// filter/category change (the map_data store, see map_data in dashboard.py); switching the race or
+// the NR variable only recolours the cached template (the map_template store) in the browser.
+
+(function() {
+    function choropleth(template, states, values, label) {
+        var trace = Object.assign({}, template.data[0], {
+            locations: states,
+            hovertext: states,
+            z: values,
+            hovertemplate: '<b>%{hovertext}</b><br><br>STATE=%{location}<br>' + label + '=%{z}<extra></extra>'
+        });
+        var coloraxis = Object.assign({}, template.layout.coloraxis, {colorbar: {title: {text: label}}});
+
+        return {data: [trace], layout: Object.assign({}, template.layout, {coloraxis: coloraxis})};
+    }
+
+    // the map of a variable the upload did not merge: no states coloured, and a title saying why
+    function empty(template, note) {
+        var figure = choropleth(template, [], [], '');
+        figure.layout = Object.assign({}, figure.layout, {title: {text: note}});
+
+        return figure;
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        maps: {
+            race: function(data, race, template) {
+                if (!data || !template) {
+                    return window.dash_clientside.no_update;
+                }
+                if (!(race in data.races)) {
+                    return empty(template, data.note);
+                }
+                return choropleth(template, data.states, data.races[race], race);
+            },
+
+            nr: function(data, variable, template) {
+                if (!data || !template) {
+                    return window.dash_clientside.no_update;
+                }
+                if (!(variable in data.nr)) {
+                    return empty(template, 'Not merged with this upload: ' + (data.labels[variable] || 'Gini Index and Racial Bias'));
+                }
+                return choropleth(template, data.states, data.nr[variable], data.labels[variable]);
+            }
+        }
+    });
+})();
@@ -0,0 +1,106 @@
+// Chunked, resumable uploads for large files (see UploadStore in dashboard.py). A file over
+// CHUNKED_BYTES dropped on or picked in the upload-data box is taken away from dcc.Upload, which
+// would read it into the page as a base64 string, and sent in parts to /upload/<id> instead. After
+// a dropped connection the upload asks the server for its offset and carries on from there. The
+// finished upload's name is handed to clean_data through the hidden upload-path input.
+
+(function() {
+    var ROUTE = '/upload/';
+    var CHUNKED_BYTES = 8 * 1024 * 1024;
+    var CHUNK_BYTES = 4 * 1024 * 1024;
+    var ATTEMPTS = 5;
+
+    function uploadId(file) {
+        // Stable per browser and file, so selecting the same file again resumes it
+        var salt = window.localStorage.getItem('cdsc-upload-salt');
+        if (!salt) {
+            salt = Math.random().toString(36).slice(2);
+            window.localStorage.setItem('cdsc-upload-salt', salt);
+        }
+        return (salt + '-' + file.name + '-' + file.size + '-' + file.lastModified).replace(/[^\w-]/g, '_');
+    }
+
+    function request(method, url, body) {
+        return fetch(url, {method: method, body: body, credentials: 'same-origin'}).then(function(response) {
+            // 409 means the chunk did not start at the stored offset; the body says where to resume
+            if (!response.ok && response.status !== 409) {
+                throw new Error(response.status);
+            }
+            return response.json();
+        });
+    }
+
+    function sendFrom(file, id, offset, progress) {
+        progress(offset);
+        if (offset >= file.size) {
+            return request('POST', ROUTE + id + '/complete?filename=' + encodeURIComponent(file.name));
+        }
+        return request('POST', ROUTE + id + '?offset=' + offset, file.slice(offset, offset + CHUNK_BYTES)).then(function(result) {
+            return sendFrom(file, id, result.offset, progress);
+        });
+    }
+
+    function upload(file, progress, attempts) {
+        var id = uploadId(file);
+        return request('GET', ROUTE + id).then(function(result) {
+            return sendFrom(file, id, result.offset, progress);
+        }).catch(function(error) {
+            if (attempts <= 1) {
+                throw error;
+            }
+            return new Promise(function(resolve) { setTimeout(resolve, 1000); }).then(function() {
+                return upload(file, progress, attempts - 1);
+            });
+        });
+    }
+
+    function setInputValue(input, value) {
+        // dcc.Input is a controlled React input: set the value through the native setter and fire
+        // the input event React listens for, so Dash picks up the change
+        var setter = Object.getOwnPropertyDescriptor(window.HTMLInputElement.prototype, 'value').set;
+        setter.call(input, value);
+        input.dispatchEvent(new Event('input', {bubbles: true}));
+    }
+
+    function start(file) {
+        var status = document.getElementById('upload-progress');
+        var progress = function(offset) {
+            status.textContent = 'uploading ' + file.name + ': ' + Math.floor(100 * offset / Math.max(file.size, 1)) + '%';
+        };
+
+        upload(file, progress, ATTEMPTS).then(function(result) {
+            status.textContent = 'uploaded ' + file.name;
+            setInputValue(document.getElementById('upload-path'), result.upload);
+        }, function(error) {
+            status.textContent = 'upload of ' + file.name + ' failed (' + error.message + '), select the file again to resume';
+        });
+    }
+
+    function intercept(event, files) {
+        // Runs in the capture phase on window, before dcc.Upload's own handlers see the event.
+        // Returns whether the file was taken over; smaller files are left to dcc.Upload untouched
+        if (!files || files.length !== 1 || files[0].size <= CHUNKED_BYTES) {
+            return false;
+        }
+        event.preventDefault();
+        event.stopPropagation();
+        start(files[0]);
+        return true;
+    }
+
+    window.addEventListener('change', function(event) {
+        if (event.target.closest && event.target.closest('#upload-data')) {
+            if (intercept(event, event.target.files)) {
+                // dcc.Upload never sees this change, so clear the input here for picking the
+                // same file again (to resume it) to fire another change
+                event.target.value = '';
+            }
+        }
+    }, true);
+
+    window.addEventListener('drop', function(event) {
+        if (event.target.closest && event.target.closest('#upload-data')) {
+            intercept(event, event.dataTransfer && event.dataTransfer.files);
+        }
+    }, true);
+})();
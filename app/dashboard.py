@@ -5,38 +5,603 @@
 import numpy as np
 import pandas as pd
 import dash
+import flask
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_table
-from dash.dependencies import Input, Output, State
+from dash.dependencies import ClientsideFunction, Input, Output, State
 from dash.exceptions import PreventUpdate
 import plotly.graph_objs as go
 import plotly.express as px
 from plotly.subplots import make_subplots
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import base64
+import bisect
+import functools
+import hashlib
 import io
-import urllib
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+import weakref
+import zlib
+from werkzeug.utils import secure_filename
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
 
 app = dash.Dash(__name__)
 server = app.server
 
-census_master = pd.read_csv('master_data.csv')
-census_master['zip'] = census_master['zip'].astype(str)
-census_master['zip'] = census_master['zip'].apply(lambda x: '{0:0>5}'.format(x))
+CENSUS_CSV = 'master_data.csv'
+CACHE_DIR = os.environ.get('CDSC_CACHE_DIR', '.cache')
+CENSUS_CACHE_VERSION = 3
+CENSUS_MMAP = os.environ.get('CDSC_MMAP', '0') == '1'
+RAW_DATA_ROUTE = '/download/raw_data.csv'
+MERGED_DATA_ROUTE = '/download/merged/'
+EXPORT_CHUNK_ROWS = 10000
+SESSION_DIR = os.environ.get('CDSC_SESSION_DIR', os.path.join(tempfile.gettempdir(), 'cdsc-sessions'))
+SESSION_MAX_BYTES = int(os.environ.get('CDSC_SESSION_MAX_BYTES', 512 * 2**20))
+SESSION_TTL = int(os.environ.get('CDSC_SESSION_TTL', 2 * 60 * 60))
+SUMMARY_CACHE_SIZE = int(os.environ.get('CDSC_SUMMARY_CACHE_SIZE', 128))
+SUMMARY_CACHE_BYTES = int(os.environ.get('CDSC_SUMMARY_CACHE_BYTES', 256 * 2**20))
+UPLOAD_ROUTE = '/upload/'
+UPLOAD_DIR = os.environ.get('CDSC_UPLOAD_DIR', os.path.join(tempfile.gettempdir(), 'cdsc-uploads'))
+UPLOAD_MAX_BYTES = int(os.environ.get('CDSC_UPLOAD_MAX_BYTES', 2 * 2**30))
+STREAM_MERGE_BYTES = int(os.environ.get('CDSC_STREAM_MERGE_BYTES', 256 * 2**20))
+STREAM_MERGE_POLL_MS = 2000
+MERGE_CHUNK_ROWS = int(os.environ.get('CDSC_MERGE_CHUNK_ROWS', 100000))
+MERGE_WORKERS = int(os.environ.get('CDSC_MERGE_WORKERS', 1))
+PARALLEL_MERGE_ROWS = int(os.environ.get('CDSC_PARALLEL_MERGE_ROWS', 500000))
+METRICS = os.environ.get('CDSC_METRICS', '0') == '1'
+METRICS_TRACEMALLOC = METRICS and os.environ.get('CDSC_METRICS_TRACEMALLOC', '0') == '1'
+METRICS_ROUTE = '/metrics'
+
+
+ZIP_SPACE = 100000
+ZIP_PATTERN = r'^\s*(\d{1,5})(?:\.0*)?(?:\s*-\s*\d{4})?\s*$'
+
+
+def canonicalize_zip(zips):
+
+    """
+    Converts a column of zip codes into integer keys in a fixed number of vectorized passes.
+    Handles integers, Excel floats ("2138.0"), ZIP+4 ("02138-1234"), padding whitespace,
+    blanks and NaN
+
+    Input:
+        zips - a pandas series of zip codes
+
+    Ouput:
+        A numpy int64 array of keys (-1 where the zip could not be keyed) and the number of
+        rows that could not be keyed
+    """
+    if pd.api.types.is_numeric_dtype(zips) and not pd.api.types.is_bool_dtype(zips):
+        keys = zips.to_numpy(dtype = float, na_value = np.nan)
+    else:
+        digits = zips.astype(str).str.extract(ZIP_PATTERN, expand = False)
+        keys = pd.to_numeric(digits, errors = 'coerce').to_numpy(dtype = float)
+
+    with np.errstate(invalid = 'ignore'):
+        valid = (keys >= 0) & (keys < ZIP_SPACE) & (keys == np.floor(keys))
+    keys = np.where(valid, keys, -1).astype(np.int64)
+
+    return keys, int((~valid).sum())
+
+
+def format_zip(keys, zips):
+    formatted = pd.Series(keys, index = zips.index).astype(str).str.zfill(5)
+
+    return formatted.where(keys >= 0, zips)
+
+
+def file_fingerprint(path):
+    stat = os.stat(path)
+
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+
+def file_hash(path, chunk_size = 1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def read_census_csv(path):
+    df = pd.read_csv(path, dtype = {'zip': str, 'STATE': str})
+    keys, _ = canonicalize_zip(df['zip'])
+    df['zip'] = format_zip(keys, df['zip'])
+
+    return df
+
+
+def compact_census(df):
+
+    """
+    Narrows the census master once at load: integer counts to the smallest integer type holding
+    them, floats to float32 where every value prints back unchanged from float32, STATE to a
+    categorical and zip to an int32 key (-1 where it could not be keyed)
+
+    Input:
+        df - the census master as read by read_census_csv
+
+    Ouput:
+        A compacted copy of df
+    """
+    columns = {}
+    for column in df.columns:
+        series = df[column]
+        if column == 'zip':
+            keys, _ = canonicalize_zip(series)
+            columns[column] = keys.astype(np.int32)
+        elif column == 'STATE':
+            columns[column] = series.astype('category')
+        elif pd.api.types.is_integer_dtype(series):
+            columns[column] = pd.to_numeric(series, downcast = 'integer')
+        elif pd.api.types.is_float_dtype(series):
+            narrow = series.astype(np.float32)
+            columns[column] = narrow if narrow.astype(str).astype(float).equals(series) else series
+        else:
+            columns[column] = series
+
+    return pd.DataFrame(columns, index = df.index)
+
+
+def widen_float32(df):
+
+    """
+    Converts float32 columns to the float64 values they print as, so csv exports and table
+    records show 0.0001 rather than 1e-04 or 9.999999747378752e-05
+    """
+    narrow = [c for c in df.columns if df[c].dtype == np.float32]
+    if not narrow:
+        return df
+
+    df = df.copy()
+    for column in narrow:
+        # census values repeat, so only the distinct values go through their repr
+        codes, uniques = pd.factorize(df[column])
+        wide = np.array([float(str(value)) for value in np.asarray(uniques, dtype = np.float32)] + [np.nan])
+        df[column] = wide[codes]
+
+    return df
+
+
+def memory_report(before, after):
+
+    """
+    Per column and total memory of the census master before and after compact_census
+
+    Ouput:
+        A pandas dataframe of dtypes and bytes per column, with a final 'total' row
+    """
+    report = pd.DataFrame({
+        'dtype_before': before.dtypes.astype(str),
+        'bytes_before': before.memory_usage(index = False, deep = True),
+        'dtype_after': after.dtypes.astype(str),
+        'bytes_after': after.memory_usage(index = False, deep = True),
+    })
+    report.loc['total'] = ['', report['bytes_before'].sum(), '', report['bytes_after'].sum()]
+
+    return report
+
+
+def _write_json(path, obj):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+def arrow_column(series, type = None):
+    if series.dtype.kind == 'f':
+        return pa.array(series.to_numpy(), type = type, from_pandas = False)
+
+    return pa.Array.from_pandas(series, type = type)
+
+
+def write_arrow_frame(df, path):
+
+    """
+    Writes a dataframe (its columns, not its index) as an uncompressed Arrow IPC file. NaN is
+    kept as a float value rather than turned into an Arrow null, so every numeric column can be
+    mapped without a copy. Raises pa.ArrowException for columns Arrow cannot type, such as
+    objects of mixed types
+    """
+    table = pa.Table.from_arrays([arrow_column(df[c]) for c in df.columns], names = list(df.columns))
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def settle_csv_types(path, dtype = None, chunk_rows = MERGE_CHUNK_ROWS):
+
+    """
+    Reads a csv chunk_rows rows at a time and settles each column's type over the whole file the
+    way one pd.read_csv would: integers widen to floats, any other mix is read as strings. Reading
+    the chunks again with these types keeps every column the same type all the way down the file
+
+    Input:
+        path - the csv
+        dtype - types forced on columns, as in pd.read_csv
+
+    Ouput:
+        An ordered dict of column to numpy dtype, or to str
+    """
+    seen = OrderedDict()
+    for chunk in pd.read_csv(path, chunksize = chunk_rows, dtype = dtype):
+        for column in chunk.columns:
+            seen.setdefault(column, set()).add(chunk[column].dtype)
+
+    types = OrderedDict()
+    for column, dtypes in seen.items():
+        if all(d.kind in 'iuf' for d in dtypes) or (len(dtypes) == 1 and dtypes != {np.dtype(object)}):
+            types[column] = np.result_type(*dtypes)
+        else:
+            types[column] = str
+
+    return types
+
+
+def write_arrow_csv(path, out_path, dtype = None, chunk_rows = MERGE_CHUNK_ROWS):
+
+    """
+    Converts a csv into an Arrow file like write_arrow_frame's, chunk_rows rows at a time, with
+    the column types settled over the whole file first (see settle_csv_types)
+
+    Input:
+        path - the csv
+        out_path - where the Arrow file is written
+        dtype - types forced on columns, as in pd.read_csv
+    """
+    types = settle_csv_types(path, dtype, chunk_rows)
+    schema = pa.schema([
+        (c, pa.string() if t is str else pa.from_numpy_dtype(t)) for c, t in types.items()
+    ])
+
+    tmp_path = '{}.{}.tmp'.format(out_path, os.getpid())
+    try:
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, schema) as writer:
+                for chunk in pd.read_csv(path, chunksize = chunk_rows, dtype = types):
+                    arrays = [arrow_column(chunk[f.name], f.type) for f in schema]
+                    writer.write_batch(pa.RecordBatch.from_arrays(arrays, names = schema.names))
+        os.replace(tmp_path, out_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def read_arrow_frame(path, mmap = CENSUS_MMAP):
+
+    """
+    Reads a file written by write_arrow_frame. With mmap the numeric columns are zero-copy
+    views of the mapped file (one block per column, never consolidated), so every worker
+    process maps the same physical pages instead of holding a private copy
+    """
+    if mmap:
+        df = pa.ipc.open_file(pa.memory_map(path)).read_all().to_pandas(split_blocks = True)
+    else:
+        with pa.OSFile(path) as source:
+            df = pa.ipc.open_file(source).read_all().to_pandas()
+
+    # Arrow hands missing strings back as None; read_csv (and so every upload) has NaN
+    for column in df.columns:
+        if df[column].dtype == object and df[column].hasnans:
+            df[column] = df[column].fillna(np.nan)
+
+    return df
+
+
+def load_census_master(path = CENSUS_CSV, cache_dir = CACHE_DIR):
+
+    """
+    Loads the census master table from a binary Arrow cache, rebuilding the cache from the csv
+    whenever the csv's size, mtime or content hash no longer matches the recorded fingerprint.
+    The cache holds the compacted table (see compact_census); the memory it saves is printed.
+    Set CDSC_MMAP=1 to memory-map the cache rather than read it (see read_arrow_frame)
+
+    Input:
+        path - path to master_data.csv
+        cache_dir - directory holding the Arrow cache and its fingerprint
+
+    Ouput:
+        A compacted pandas dataframe keyed by integer zip codes
+    """
+    cache_path = os.path.join(cache_dir, 'master_data.arrow')
+    meta_path = os.path.join(cache_dir, 'master_data.json')
+    fingerprint = file_fingerprint(path)
+
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        meta = {}
+
+    if pa is not None and meta.get('version') == CENSUS_CACHE_VERSION and os.path.exists(cache_path):
+        fresh = meta.get('size') == fingerprint['size'] and meta.get('mtime') == fingerprint['mtime']
+        if not fresh and meta.get('size') == fingerprint['size']:
+            # a fresh checkout touches the mtime without changing the file
+            fresh = meta.get('sha256') == file_hash(path)
+        if fresh:
+            try:
+                df = read_arrow_frame(cache_path)
+                if meta.get('mtime') != fingerprint['mtime']:
+                    _write_json(meta_path, dict(meta, **fingerprint))
+                print('census_master: {:.1f} MB (compacted from {:.1f} MB){}'.format(
+                    meta.get('bytes_after', 0) / 2**20, meta.get('bytes_before', 0) / 2**20,
+                    ', memory-mapped' if CENSUS_MMAP else ''))
+                return df
+            except Exception as e:
+                print(e)
+
+    raw = read_census_csv(path)
+    df = compact_census(raw)
+    report = memory_report(raw, df)
+    print(report.to_string())
+    if pa is None:
+        print('pyarrow is not installed, the census cache is disabled')
+        return df
+
+    try:
+        os.makedirs(cache_dir, exist_ok = True)
+        write_arrow_frame(df, cache_path)
+        _write_json(meta_path, dict(
+            fingerprint,
+            sha256 = file_hash(path),
+            version = CENSUS_CACHE_VERSION,
+            bytes_before = int(report.loc['total', 'bytes_before']),
+            bytes_after = int(report.loc['total', 'bytes_after']),
+        ))
+    except (pa.ArrowException, OSError) as e:
+        print(e)
+        return df
+    if CENSUS_MMAP:
+        # map the file just written, like every later start will
+        return read_arrow_frame(cache_path)
+
+    return df
+
+
+def build_zip_index(master):
+
+    """
+    Builds a dense lookup array mapping every integer zip code (0-99999) to its row position
+    in the master table, -1 where the zip code is not present
+
+    Input:
+        master - a pandas dataframe with a zip column
+
+    Ouput:
+        A numpy int32 array of length ZIP_SPACE
+    """
+    keys, _ = canonicalize_zip(master['zip'])
+    rows = np.flatnonzero(keys >= 0)
+
+    index = np.full(ZIP_SPACE, -1, dtype = np.int32)
+    # assign in reverse so the first occurrence of a duplicated zip wins
+    index[keys[rows[::-1]]] = rows[::-1]
+
+    return index
+
+
+def lookup_zip_positions(index, keys):
+    keys = np.asarray(keys, dtype = np.int64)
+    positions = np.full(len(keys), -1, dtype = np.int32)
+    valid = (keys >= 0) & (keys < ZIP_SPACE)
+    positions[valid] = index[keys[valid]]
+
+    return positions
+
+
+def take_census_rows(positions, columns = None, pool = None):
+
+    """
+    Gathers census master rows by position, -1 marking rows without a match
+
+    Input:
+        positions - a numpy integer array of row positions into census_master
+        columns - the census columns to gather (see census_group_columns), all when None
+        pool - an executor to gather the columns in (see merge_pool), in this thread when None
+
+    Ouput:
+        A pandas dataframe of census columns aligned with positions, NaN where unmatched
+    """
+    unmatched = (positions < 0).any()
+    columns = census_columns if columns is None else columns
+
+    def gather(column):
+        # the ndarray (or Categorical) itself: a wrapping PandasArray would be copied again below
+        values = census_master[column].values
+        if unmatched and values.dtype.kind in 'iu' and values.dtype.itemsize <= 2:
+            # unmatched rows need NaN; the narrow integer counts fit float32 exactly
+            values = values.astype(np.float32)
+        return pd.api.extensions.take(values, positions, allow_fill = True)
+
+    # gather column by column: a frame-level take would consolidate (and so copy) a mapped master.
+    # pandas' take runs without the GIL, so the columns can be gathered in parallel threads
+    gathered = map(gather, columns) if pool is None else pool.map(gather, columns)
+
+    return pd.DataFrame(dict(zip(columns, gathered)), index = pd.RangeIndex(len(positions)))
+
+
+census_master = load_census_master()
+census_columns = [c for c in census_master.columns if c != 'zip']
+census_zip_index = build_zip_index(census_master)
 
 
 
 vals = list(census_master.columns)
 
+CENSUS_GROUPS = {
+    'Population': ['tot_pop_'],
+    'Income': ['med_fam_inc_'],
+    'Health': ['health_ins_'],
+    'Unemployment': ['unemp_'],
+    'Education': ['hs_dip_'],
+    'Gini Index': ['gini_index'],
+    'Racial Bias': ['explicit_', 'implicit_'],
+}
+
+
+def census_group_columns(groups = None):
+
+    """
+    The census columns of the selected variable families, in census_master order. STATE is always
+    kept since every per state view needs it
+
+    Input:
+        groups - keys of CENSUS_GROUPS, or None for every census column
+
+    Ouput:
+        A list of census_columns
+    """
+    if groups is None:
+        return list(census_columns)
+    prefixes = tuple(prefix for group in groups for prefix in CENSUS_GROUPS[group])
+
+    return [c for c in census_columns if c == 'STATE' or c.startswith(prefixes)]
+
+
 
+def gen_census_data(df, groups = None, pool = None):
 
-def gen_census_data(df):
+    """
+    Left joins the census master onto an uploaded study by zip code
+
+    Input:
+        df - a pandas dataframe with a 'Zip.Code' or 'zip' column
+        groups - keys of CENSUS_GROUPS to merge, every census column when None
+        pool - an executor to gather the census columns in (see take_census_rows)
+
+    Ouput:
+        The merged pandas dataframe and the number of rows without a census match
+    """
     df = df.rename(columns = {'Zip.Code': 'zip'})
-    df['zip'] = df['zip'].astype(str)
-    df['zip'] = df['zip'].apply(lambda x: '{0:0>5}'.format(x))
-    export = pd.merge(df, census_master, how= 'left', on='zip')
-    
-    return export
+
+    # longitudinal studies repeat the same zips across waves: canonicalize, format and look up
+    # each distinct zip once, then expand back to row order through the codes
+    codes, uniques = pd.factorize(df['zip'])
+    uniques = pd.Series(uniques)
+    unique_keys, _ = canonicalize_zip(uniques)
+    unique_zips = format_zip(unique_keys, uniques).to_numpy(dtype = object)
+    positions = lookup_zip_positions(census_zip_index, unique_keys)
+
+    missing = codes < 0
+    if missing.any():
+        # blank zips get their own unmatched slot past the distinct zips (the only slot when
+        # every zip is blank)
+        positions = np.append(positions, -1)
+        unique_zips = np.append(unique_zips, None)
+        codes = np.where(missing, len(uniques), codes)
+    df['zip'] = np.where(missing, df['zip'], unique_zips[codes])
+    # blank, unreadable and well formed zips the master lacks alike
+    unmatched = int((positions[codes] < 0).sum())
+
+    census = take_census_rows(positions[codes], census_group_columns(groups), pool)
+
+    # mirror pd.merge's suffixing of columns present on both sides
+    # (df is already this function's own copy and census was just gathered, so neither the
+    # renames nor the concat need to copy the columns again)
+    overlap = df.columns.intersection(census.columns)
+    df = df.rename(columns = {c: c + '_x' for c in overlap}, copy = False)
+    df.index = pd.RangeIndex(len(df))
+    census = census.rename(columns = {c: c + '_y' for c in overlap}, copy = False)
+    export = pd.concat([df, census], axis = 1, copy = False)
+
+    return export, unmatched
+
+
+_merge_pools = {}
+_merge_pool_lock = threading.Lock()
+
+
+def merge_pool(workers = MERGE_WORKERS):
+
+    """
+    The thread pool of the given size every parallel merge of this worker shares, so concurrent
+    uploads queue for the same workers cores instead of each starting their own
+    """
+    with _merge_pool_lock:
+        if workers not in _merge_pools:
+            _merge_pools[workers] = ThreadPoolExecutor(workers, thread_name_prefix = 'merge')
+
+    return _merge_pools[workers]
+
+
+def parallel_census_merge(df, groups = None, workers = MERGE_WORKERS, min_rows = PARALLEL_MERGE_ROWS):
+
+    """
+    gen_census_data with the census columns of a large upload gathered in merge_pool threads
+    against the one read-only census_master (nothing is copied per task). The distinct zips are
+    looked up once for the whole upload, since that part holds the GIL. Uploads shorter than
+    min_rows, or workers <= 1, are merged in this thread
+
+    Ouput:
+        The merged pandas dataframe and the number of rows without a census match
+    """
+    if workers <= 1 or len(df) < min_rows:
+        return gen_census_data(df, groups)
+
+    return gen_census_data(df, groups, merge_pool(workers))
+
+
+def stream_census_merge(path, out_path, groups = None, chunk_rows = MERGE_CHUNK_ROWS):
+
+    """
+    Merges a csv study into a csv at out_path chunk_rows rows at a time, so that memory is bounded
+    by the chunk size rather than by the size of the study. The study's column types are settled
+    over the whole file first (see settle_csv_types), so that a column reads, and is written, the
+    same in every chunk as in one pd.read_csv of the study
+
+    Input:
+        path - the csv study (with a 'Zip.Code' or 'zip' column)
+        out_path - where the merged csv (with a utf-8 byte order mark) is written
+        groups - keys of CENSUS_GROUPS to merge, every census column when None
+
+    Ouput:
+        The number of merged rows and the number of rows without a census match
+    """
+    types = settle_csv_types(path, chunk_rows = chunk_rows)
+    rows = unmatched = 0
+    tmp_path = '{}.{}.tmp'.format(out_path, os.getpid())
+    try:
+        with open(tmp_path, 'w', encoding = 'utf-8-sig', newline = '') as out:
+            for chunk in pd.read_csv(path, chunksize = chunk_rows, dtype = types):
+                merged, missing = gen_census_data(chunk, groups)
+                # a chunk without unmatched rows keeps integer census columns; write every chunk
+                # as floats so the column reads the same all the way down the file
+                census = merged.columns[chunk.shape[1]:]
+                merged = merged.astype({c: float for c in census if pd.api.types.is_integer_dtype(merged[c])})
+                merged = widen_float32(merged)
+                merged.to_csv(out, index = False, header = rows == 0)
+                rows += len(merged)
+                unmatched += missing
+        os.replace(tmp_path, out_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return rows, unmatched
 
 
 def parse_contents(contents, filename):
@@ -44,13 +609,25 @@ def parse_contents(contents, filename):
     content_type, content_string = contents.split(',')
 
     decoded = base64.b64decode(content_string)
+
+    return read_upload(io.BytesIO(decoded), filename)
+
+
+def read_upload(source, filename):
+
+    """
+    Reads an uploaded csv or Excel file from a path or a binary buffer
+
+    Ouput:
+        A pandas dataframe, or an html.Div error message if the file could not be read
+    """
     try:
         if 'csv' in filename:
            
-            df = pd.read_csv(io.StringIO(decoded.decode('utf-8')))
+            df = pd.read_csv(source)
         elif 'xls' in filename:
            
-            df = pd.read_excel(io.BytesIO(decoded))
+            df = pd.read_excel(source)
     except Exception as e:
         print(e)
         return html.Div([
@@ -60,353 +637,1323 @@ def parse_contents(contents, filename):
     return df
 
 
-def aggregate_health_unemp(df):
-    
-    df['white_unemp'] = df['unemp_white_m'] + df['unemp_white_f']
-    df['black_unemp'] = df['unemp_black_m'] + df['unemp_black_f']
-    df['asian_unemp'] = df['unemp_asian_m'] + df['unemp_asian_f']
-    df['native_unemp'] = df['unemp_native_m'] + df['unemp_native_f']
-    df['pacif_unemp'] = df['unemp_pacif_m'] + df['unemp_pacif_f']
-    df['other_unemp'] = df['unemp_other_m'] + df['unemp_other_f']
-    
-    df['white_hs_dip'] = df['hs_dip_white_m'] + df['hs_dip_white_f']
-    df['black_hs_dip'] = df['hs_dip_black_m'] + df['hs_dip_black_f']
-    df['asian_hs_dip'] = df['hs_dip_asian_m'] + df['hs_dip_asian_f']
-    df['native_hs_dip'] = df['hs_dip_native_m'] + df['hs_dip_native_f']
-    df['pacif_hs_dip'] = df['hs_dip_pacif_m'] + df['hs_dip_pacif_f']
-    df['other_hs_dip'] = df['hs_dip_pacif_m'] + df['hs_dip_pacif_f']
-    
-    export = df.drop([
-        'hs_dip_white_m',
-        'hs_dip_white_f',
-        'hs_dip_black_m',
-        'hs_dip_black_f',
-        'hs_dip_native_m',
-        'hs_dip_native_f',
-        'hs_dip_asian_m',
-        'hs_dip_asian_f',
-        'hs_dip_pacif_m',
-        'hs_dip_pacif_f',
-        'hs_dip_pacif_m',
-        'hs_dip_pacif_f',
-        'unemp_white_m',
-        'unemp_white_f',
-        'unemp_black_m',
-        'unemp_black_f',
-        'unemp_native_m',
-        'unemp_native_f',
-        'unemp_asian_m',
-        'unemp_asian_f',
-        'unemp_pacif_m',
-        'unemp_pacif_f',
-        'unemp_other_m',
-        'unemp_other_f'
-    ],
-    axis = 1
+class SessionStore:
+
+    """
+    Keeps merged dataframes on the server keyed by a session token so that only the token travels
+    through the callback graph. Entries are held in an in-process LRU bounded by total bytes and
+    spilled to spill_dir, where other workers (or this one after eviction) can reload them. Both
+    copies expire ttl seconds after the token was last read (get and file refresh them). Merges too large to hold are written straight to a csv in
+    spill_dir (see stream_census_merge), which downloads serve as is and map_csv converts once
+    into an Arrow spill for the views
+
+    Spills are Arrow files (see write_arrow_frame) where pyarrow can type the frame, pickles
+    otherwise. An Arrow spill is memory-mapped rather than read, and the mapped frame is what the
+    LRU keeps: its numeric columns live in the page cache, so only the rest counts against
+    max_bytes, and a frame too large to hold is mapped once instead of reloaded on every get()
+    """
+
+    def __init__(self, max_bytes = SESSION_MAX_BYTES, ttl = SESSION_TTL, spill_dir = SESSION_DIR):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.spill_dir = spill_dir
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def put(self, df, token = None):
+        token = token or uuid.uuid4().hex
+        nbytes = int(df.memory_usage(deep = True).sum())
+        created = time.time()
+
+        path = self._spill(df, token, created)
+        if nbytes > self.max_bytes and path is not None and path.endswith('.arrow'):
+            df, nbytes = self._map(path)
+
+        with self._lock:
+            self._hold(token, df, nbytes, created)
+
+        return token
+
+    def get(self, token):
+        if not token or not isinstance(token, str) or not re.fullmatch(r'[\w-]+', token):
+            return None
+
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None:
+                if now - entry[2] <= self.ttl:
+                    self._entries[token] = (entry[0], entry[1], now)
+                    self._entries.move_to_end(token)
+                else:
+                    self._discard(token)
+                    entry = None
+        if entry is not None:
+            self._touch(token, now)
+            return entry[0]
+
+        if not self.spill_dir:
+            return None
+        paths = [p for p in (self._arrow_path(token), self._pickle_path(token), self.csv_path(token)) if os.path.exists(p)]
+        if not paths:
+            return None
+        path = paths[0]
+        try:
+            created = os.path.getmtime(path)
+            if now - created > self.ttl:
+                os.remove(path)
+                return None
+            self._touch(token, now)
+            if path.endswith('.arrow'):
+                df, nbytes = self._map(path)
+            elif path.endswith('.csv'):
+                df = pd.read_csv(path, dtype = {'zip': str})
+                nbytes = int(df.memory_usage(deep = True).sum())
+            else:
+                df = pd.read_pickle(path)
+                nbytes = int(df.memory_usage(deep = True).sum())
+        except (OSError, EOFError, ValueError):
+            return None
+
+        with self._lock:
+            if token not in self._entries:
+                self._hold(token, df, nbytes, now)
+
+        return df
+
+    def csv_path(self, token):
+        return os.path.join(self.spill_dir, token + '.csv')
+
+    def job_path(self, token):
+        return os.path.join(self.spill_dir, token + '.job')
+
+    def job(self, token):
+
+        """
+        The outcome start_stream_merge recorded for token (the merged and unmatched rows, or the
+        error), or None while the merge is still running
+        """
+        if not self.spill_dir or not token or not isinstance(token, str) or not re.fullmatch(r'[\w-]+', token):
+            return None
+        try:
+            with open(self.job_path(token)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def map_csv(self, token):
+
+        """
+        Converts the csv stream_census_merge wrote for token into an Arrow spill, so that get()
+        maps the rows instead of parsing the whole csv on every call. The csv stays for file().
+        Without pyarrow, or if the conversion fails, get() falls back to reading the csv
+        """
+        if pa is None:
+            return
+        try:
+            write_arrow_csv(self.csv_path(token), self._arrow_path(token), dtype = {'zip': str})
+        except (OSError, ValueError, pa.ArrowException) as e:
+            print(e)
+
+    def file(self, token):
+
+        """
+        The merged csv of a token stored as a file by stream_census_merge, or None for tokens held
+        as dataframes
+        """
+        if not self.spill_dir or not token or not isinstance(token, str) or not re.fullmatch(r'[\w-]+', token):
+            return None
+        path = self.csv_path(token)
+        now = time.time()
+        try:
+            if now - os.path.getmtime(path) <= self.ttl:
+                self._touch(token, now)
+                return path
+        except OSError:
+            pass
+
+        return None
+
+    def _touch(self, token, now):
+        # a token's ttl runs from its last use: refresh the spill files so that other workers and
+        # _sweep_spill see the use too
+        if not self.spill_dir:
+            return
+        for path in (self._arrow_path(token), self._pickle_path(token), self.csv_path(token)):
+            try:
+                os.utime(path, (now, now))
+            except OSError:
+                pass
+
+    def _hold(self, token, df, nbytes, created):
+        self._discard(token)
+        if nbytes <= self.max_bytes:
+            self._entries[token] = (df, nbytes, created)
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+
+    def _discard(self, token):
+        entry = self._entries.pop(token, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def _spill(self, df, token, now):
+
+        """
+        Writes df to spill_dir as an Arrow file, or as a pickle when pyarrow is missing or cannot
+        type it (an index other than 0..n-1, non string column names, mixed object columns)
+
+        Ouput:
+            The path written, or None if the spill failed
+        """
+        if not self.spill_dir:
+            return None
+        try:
+            os.makedirs(self.spill_dir, exist_ok = True)
+            self._sweep_spill(now)
+            if pa is not None and df.index.equals(pd.RangeIndex(len(df))) and df.columns.is_unique \
+                    and all(isinstance(c, str) for c in df.columns):
+                try:
+                    path = self._arrow_path(token)
+                    write_arrow_frame(df, path)
+                    return path
+                except pa.ArrowException:
+                    pass
+            path = self._pickle_path(token)
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            df.to_pickle(tmp_path)
+            os.replace(tmp_path, path)
+            return path
+        except OSError as e:
+            print(e)
+            return None
+
+    def _map(self, path):
+
+        """
+        Maps an Arrow spill
+
+        Ouput:
+            The dataframe and the bytes it holds outside the mapped file (the columns that are not
+            plain integers or floats)
+        """
+        df = read_arrow_frame(path, mmap = True)
+        heap = [c for c in df.columns if df[c].dtype.kind not in 'iuf']
+
+        return df, int(sum(df[c].memory_usage(index = False, deep = True) for c in heap))
+
+    def _arrow_path(self, token):
+        return os.path.join(self.spill_dir, token + '.arrow')
+
+    def _pickle_path(self, token):
+        return os.path.join(self.spill_dir, token + '.pkl')
+
+    def _sweep_spill(self, now):
+        for name in os.listdir(self.spill_dir):
+            path = os.path.join(self.spill_dir, name)
+            try:
+                if now - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+session_store = SessionStore()
+
+
+class UploadStore:
+
+    """
+    Chunked, resumable uploads written straight to upload_dir, so a large export is never held in
+    memory as a base64 string. A client appends parts to <id>.part at the offset the server
+    reports (asking for it again to resume) and then completes the upload into a file that
+    clean_data reads from disk. An upload may grow to max_bytes; files older than ttl, abandoned
+    parts included, are swept whenever a chunk arrives. Each upload has its own lock, so a slow
+    client only holds up its own chunks
+    """
+
+    def __init__(self, upload_dir = UPLOAD_DIR, ttl = SESSION_TTL, max_bytes = UPLOAD_MAX_BYTES):
+        self.upload_dir = upload_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._locks = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def offset(self, upload_id):
+        path = self._part_path(upload_id)
+
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    def append(self, upload_id, offset, stream, length):
+
+        """
+        Appends the request body to the upload if it starts where the stored part ends. Raises
+        OverflowError if the body (of length bytes) would take the upload past max_bytes
+
+        Ouput:
+            The stored size afterwards and whether the chunk was accepted
+        """
+        with self._upload_lock(upload_id):
+            current = self.offset(upload_id)
+            if offset != current:
+                return current, False
+            if current + length > self.max_bytes:
+                raise OverflowError(upload_id)
+
+            os.makedirs(self.upload_dir, exist_ok = True)
+            self._sweep(time.time())
+            with open(self._part_path(upload_id), 'ab') as part:
+                shutil.copyfileobj(stream, part)
+
+            return self.offset(upload_id), True
+
+    def complete(self, upload_id, filename):
+
+        """
+        Moves a finished part to its own file, named so that read_upload still sees the original
+        extension
+
+        Ouput:
+            The name clean_data resolves with path()
+        """
+        name = '{}-{}'.format(uuid.uuid4().hex, secure_filename(filename) or 'upload.csv')
+        with self._upload_lock(upload_id):
+            os.replace(self._part_path(upload_id), os.path.join(self.upload_dir, name))
+        self._sweep(time.time())
+
+        return name
+
+    def path(self, name):
+        if not name or not isinstance(name, str) or not re.fullmatch(r'[\w.-]+', name):
+            return None
+        path = os.path.join(self.upload_dir, name)
+
+        return path if os.path.isfile(path) else None
+
+    def discard(self, name):
+        path = self.path(name)
+        if path is not None:
+            os.remove(path)
+
+    def _upload_lock(self, upload_id):
+        # held only as long as some request is using it, so abandoned uploads leave nothing behind
+        with self._lock:
+            lock = self._locks.get(upload_id)
+            if lock is None:
+                lock = self._locks[upload_id] = threading.Lock()
+
+        return lock
+
+    def _part_path(self, upload_id):
+        if not re.fullmatch(r'[\w-]+', upload_id):
+            raise KeyError(upload_id)
+
+        return os.path.join(self.upload_dir, upload_id + '.part')
+
+    def _sweep(self, now):
+        for name in os.listdir(self.upload_dir):
+            path = os.path.join(self.upload_dir, name)
+            try:
+                if now - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+upload_store = UploadStore()
+
+
+def estimate_merged_bytes(path, groups = None, sample_bytes = 2**20):
+
+    """
+    Estimates how many bytes the in-memory merge of a csv study would take: its rows, counted in
+    the first sample_bytes and extrapolated to the file size, times the bytes per row of the
+    census columns merged, plus the study itself. A merged frame runs to some 18 times its csv,
+    so the size of the upload alone says little about the memory the merge needs
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        sample = f.read(sample_bytes)
+    rows = size * max(sample.count(b'\n') - 1, 1) / max(len(sample), 1)
+    columns = census_group_columns(groups)
+    row_bytes = census_master[columns].memory_usage(index = False).sum() / max(len(census_master), 1)
+
+    return int(rows * row_bytes + size)
+
+
+_stream_merges = ThreadPoolExecutor(1, thread_name_prefix = 'stream-merge')
+
+
+def start_stream_merge(path, upload, groups):
+
+    """
+    Queues a streamed merge of an upload on this worker's background thread (one merge at a time,
+    each bounded by MERGE_CHUNK_ROWS), so the callback that starts it returns at once and no
+    request, nor the gunicorn timeout, waits on a merge that can take minutes. Any worker can poll
+    the outcome with session_store.job(token)
+
+    Ouput:
+        The session token the merge is stored under once it is done
+    """
+    token = uuid.uuid4().hex
+    os.makedirs(session_store.spill_dir, exist_ok = True)
+    _stream_merges.submit(run_stream_merge, path, upload, token, groups)
+
+    return token
+
+
+def run_stream_merge(path, upload, token, groups):
+    try:
+        rows, unmatched = stream_census_merge(path, session_store.csv_path(token), groups)
+        session_store.map_csv(token)
+        job = {'rows': rows, 'unmatched': unmatched}
+    except Exception as e:
+        print(e)
+        job = {'error': str(e)}
+    finally:
+        upload_store.discard(upload)
+    _write_json(session_store.job_path(token), job)
+
+
+FILTER_PART = re.compile(
+    r'^\{(?P<column>.+?)\}\s+(?P<case>[si]?)(?P<operator>>=|<=|!=|=|<|>|eq|ne|ge|le|gt|lt|contains|datestartswith)'
+    r'\s+(?P<value>.+)$'
+)
+FILTER_UNARY = re.compile(r'^\{(?P<column>.+?)\}\s+(?P<operator>is blank|is not blank)$')
+FILTER_ALIASES = {'eq': '=', 'ne': '!=', 'ge': '>=', 'le': '<=', 'gt': '>', 'lt': '<'}
+
+
+def split_filter_part(filter_part):
+
+    """
+    Parses one ' && ' separated clause of a dash_table filter_query
+
+    Ouput:
+        A tuple (column, operator, value, case_insensitive), or None when the clause is not understood
+    """
+    filter_part = filter_part.strip()
+    match = FILTER_UNARY.match(filter_part)
+    if match:
+        return match.group('column'), match.group('operator'), None, False
+
+    match = FILTER_PART.match(filter_part)
+    if not match:
+        return None
+    operator = FILTER_ALIASES.get(match.group('operator'), match.group('operator'))
+    value = match.group('value').strip()
+    if len(value) > 1 and value[0] == value[-1] and value[0] in ('"', "'", '`'):
+        value = value[1:-1].replace('\\' + value[0], value[0])
+
+    return match.group('column'), operator, value, match.group('case') == 'i'
+
+
+def filter_mask(df, filter_query):
+
+    """
+    Translates a dash_table filter_query into a vectorized boolean mask over df
+
+    Input:
+        df - a pandas dataframe
+        filter_query - the master_table filter_query string
+
+    Ouput:
+        A numpy boolean array, True for rows passing every clause
+    """
+    mask = np.ones(len(df), dtype = bool)
+    if not filter_query:
+        return mask
+
+    for filter_part in filter_query.split(' && '):
+        parsed = split_filter_part(filter_part)
+        if parsed is None or parsed[0] not in df.columns:
+            continue
+        column, operator, value, case_insensitive = parsed
+        series = df[column]
+
+        if operator in ('is blank', 'is not blank'):
+            blank = (series.isna() | (series.astype(str).str.strip() == '')).to_numpy()
+            mask &= blank if operator == 'is blank' else ~blank
+            continue
+
+        if operator in ('contains', 'datestartswith'):
+            text = series.astype(str)
+            if case_insensitive:
+                text, value = text.str.lower(), value.lower()
+            if operator == 'contains':
+                hits = text.str.contains(value, regex = False)
+            else:
+                hits = text.str.startswith(value)
+            mask &= (hits & series.notna()).to_numpy()
+            continue
+
+        number = pd.to_numeric(pd.Series([value]), errors = 'coerce')[0]
+        if pd.api.types.is_numeric_dtype(series) and not np.isnan(number):
+            left, right = series.to_numpy(dtype = float, na_value = np.nan), number
+            if series.dtype == np.float32:
+                # compare float32 census values with the float32 nearest the typed value
+                right = float(np.float32(number))
+        else:
+            left, right = series.astype(str).to_numpy(), value
+            if case_insensitive:
+                left, right = np.char.lower(left.astype(str)), right.lower()
+
+        with np.errstate(invalid = 'ignore'):
+            if operator == '=':
+                hits = left == right
+            elif operator == '!=':
+                hits = left != right
+            elif operator == '>':
+                hits = left > right
+            elif operator == '>=':
+                hits = left >= right
+            elif operator == '<':
+                hits = left < right
+            else:
+                hits = left <= right
+        mask &= np.asarray(hits, dtype = bool)
+
+    return mask
+
+
+def sort_order(df, rows, sort_by):
+
+    """
+    Returns the row positions rows of df ordered by the master_table sort_by setting. Only the
+    sorted column is gathered
+    """
+    if not sort_by or sort_by[0]['column_id'] not in df.columns:
+        return rows
+    column = df[sort_by[0]['column_id']].iloc[rows].reset_index(drop = True)
+    order = column.sort_values(ascending = sort_by[0]['direction'] == 'asc', kind = 'mergesort', na_position = 'last')
+
+    return rows[order.index.to_numpy()]
+
+
+def filter_rows(storage, filter_query):
+
+    """
+    Resolves the stored frame and the master_table filter into a row mask and a fingerprint of
+    the filtered rows. A stored frame never changes under its token, so the token plus the packed
+    mask identify the filtered content exactly
+
+    Ouput:
+        The stored dataframe, a numpy boolean mask and a hex fingerprint (all None when the
+        token has expired)
+    """
+    df = session_store.get(storage)
+    if df is None:
+        return None, None, None
+
+    mask = filter_mask(df, filter_query)
+    digest = hashlib.sha1(storage.encode('utf-8'))
+    digest.update(np.packbits(mask).tobytes())
+
+    return df, mask, '{}-{}'.format(digest.hexdigest(), len(mask))
+
+
+def summary_nbytes(value):
+
+    """
+    Estimates the bytes a summary_cache value holds: dataframes, series and arrays by their
+    buffers, tuples and lists by their items, objects with an nbytes attribute (StateAggregates)
+    by it, anything else (the binned figures) by sys.getsizeof
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(np.sum(value.memory_usage(deep = True)))
+    if isinstance(value, (tuple, list)):
+        return sum(summary_nbytes(v) for v in value)
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+
+    return sys.getsizeof(value)
+
+
+class SummaryCache:
+
+    """
+    LRU of computed summaries keyed by (kind, filtered rows fingerprint, category), with hit and
+    miss counters. It is bounded by entry count and by the estimated bytes of the values (see
+    summary_nbytes), since the per sample summaries and the per upload StateAggregates grow with
+    the rows; a value larger than max_bytes is returned without being kept. Entries expire after
+    ttl seconds, like the session tokens they are computed from
+    """
+
+    def __init__(self, maxsize = SUMMARY_CACHE_SIZE, max_bytes = SUMMARY_CACHE_BYTES, ttl = SESSION_TTL):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def memoized(self, key, compute):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[2] <= self.ttl:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry[0]
+            self._discard(key)
+            self.misses += 1
+
+        value = compute()
+        nbytes = summary_nbytes(value)
+        with self._lock:
+            self._discard(key)
+            if nbytes <= self.max_bytes:
+                self._entries[key] = (value, nbytes, now)
+                self.bytes += nbytes
+                while len(self._entries) > self.maxsize or self.bytes > self.max_bytes:
+                    self._discard(next(iter(self._entries)))
+
+        return value
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+
+summary_cache = SummaryCache()
+
+
+class CallbackMetrics:
+
+    """
+    Per callback histograms of wall time, request and response payload bytes, rows processed and
+    peak traced memory, plus error counts, rendered in the Prometheus text format. Every worker
+    process keeps its own
+    """
+
+    HISTOGRAMS = OrderedDict([
+        ('seconds', ('Callback wall time in seconds', [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60])),
+        ('request_bytes', ('Callback request payload in bytes', [4**k for k in range(4, 16)])),
+        ('response_bytes', ('Callback response payload in bytes', [4**k for k in range(4, 16)])),
+        ('rows', ('Rows of the upload a callback worked on', [10**k for k in range(8)])),
+        ('peak_bytes', ('Peak traced memory allocated during a callback in bytes', [4**k for k in range(8, 17)])),
+    ])
+
+    def __init__(self):
+        self.errors = {}
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, metric, callback, value):
+        bounds = self.HISTOGRAMS[metric][1]
+        with self._lock:
+            series = self._series.get((metric, callback))
+            if series is None:
+                series = self._series[(metric, callback)] = {'buckets': [0] * len(bounds), 'sum': 0, 'count': 0}
+            i = bisect.bisect_left(bounds, value)
+            if i < len(bounds):
+                series['buckets'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def error(self, callback):
+        with self._lock:
+            self.errors[callback] = self.errors.get(callback, 0) + 1
+
+    def render(self, cache = summary_cache):
+        lines = []
+        with self._lock:
+            for metric, (doc, bounds) in self.HISTOGRAMS.items():
+                name = 'cdsc_callback_' + metric
+                lines += ['# HELP {} {}'.format(name, doc), '# TYPE {} histogram'.format(name)]
+                for callback in sorted(c for m, c in self._series if m == metric):
+                    series = self._series[(metric, callback)]
+                    cumulative = 0
+                    for bound, count in zip(bounds, series['buckets']):
+                        cumulative += count
+                        lines.append('{}_bucket{{callback="{}",le="{}"}} {}'.format(name, callback, bound, cumulative))
+                    lines.append('{}_bucket{{callback="{}",le="+Inf"}} {}'.format(name, callback, series['count']))
+                    lines.append('{}_sum{{callback="{}"}} {}'.format(name, callback, series['sum']))
+                    lines.append('{}_count{{callback="{}"}} {}'.format(name, callback, series['count']))
+
+            lines += ['# HELP cdsc_callback_errors_total Callbacks that raised an error',
+                      '# TYPE cdsc_callback_errors_total counter']
+            lines += ['cdsc_callback_errors_total{{callback="{}"}} {}'.format(c, n) for c, n in sorted(self.errors.items())]
+
+        lines += [
+            '# HELP cdsc_summary_cache_hits_total summary_cache lookups answered from the cache',
+            '# TYPE cdsc_summary_cache_hits_total counter',
+            'cdsc_summary_cache_hits_total {}'.format(cache.hits),
+            '# HELP cdsc_summary_cache_misses_total summary_cache lookups that were computed',
+            '# TYPE cdsc_summary_cache_misses_total counter',
+            'cdsc_summary_cache_misses_total {}'.format(cache.misses),
+            '# HELP cdsc_summary_cache_bytes Estimated bytes of the values held in summary_cache',
+            '# TYPE cdsc_summary_cache_bytes gauge',
+            'cdsc_summary_cache_bytes {}'.format(cache.bytes),
+        ]
+
+        return '\n'.join(lines) + '\n'
+
+
+callback_metrics = CallbackMetrics()
+if METRICS_TRACEMALLOC:
+    tracemalloc.start()
+
+
+def instrumented(callback):
+
+    """
+    Wraps a Dash callback to record its wall time, request bytes, rows (see record_rows) and, with
+    CDSC_METRICS_TRACEMALLOC, peak traced memory in callback_metrics; the response bytes are
+    recorded once Flask has serialized the response. With CDSC_METRICS off the callback is
+    returned unwrapped, so the instrumentation costs nothing
+
+    The memory peak is process wide: it is exact under gunicorn's one request at a time workers
+    and an upper bound under a threaded server
+    """
+    if not METRICS:
+        return callback
+
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    def wrapper(*args, **kwargs):
+        flask.g.cdsc_callback = name
+        flask.g.cdsc_rows = None
+        if METRICS_TRACEMALLOC:
+            tracemalloc.reset_peak()
+            base, _ = tracemalloc.get_traced_memory()
+        start = time.perf_counter()
+        try:
+            return callback(*args, **kwargs)
+        except PreventUpdate:
+            raise
+        except Exception:
+            callback_metrics.error(name)
+            raise
+        finally:
+            callback_metrics.observe('seconds', name, time.perf_counter() - start)
+            callback_metrics.observe('request_bytes', name, flask.request.content_length or 0)
+            if flask.g.cdsc_rows is not None:
+                callback_metrics.observe('rows', name, flask.g.cdsc_rows)
+            if METRICS_TRACEMALLOC:
+                _, peak = tracemalloc.get_traced_memory()
+                callback_metrics.observe('peak_bytes', name, max(peak - base, 0))
+
+    return wrapper
+
+
+def record_rows(rows):
+    if METRICS:
+        flask.g.cdsc_rows = int(rows)
+
+
+@server.after_request
+def record_response_bytes(response):
+    callback = flask.g.get('cdsc_callback')
+    if callback is not None:
+        callback_metrics.observe('response_bytes', callback, response.content_length or 0)
+
+    return response
+
+
+@server.route(METRICS_ROUTE)
+def metrics():
+    if not METRICS:
+        flask.abort(404)
+
+    return flask.Response(callback_metrics.render(), mimetype = 'text/plain; version=0.0.4')
+
+
+RACES = ['white', 'black', 'asian', 'native', 'pacif', 'other']
+SEX_SPLIT_FAMILIES = ['unemp', 'hs_dip']
+DERIVED_COLUMNS = ['{}_{}'.format(race, family) for family in SEX_SPLIT_FAMILIES for race in RACES]
+
+
+def derive_race_columns(df):
+
+    """
+    Sums the male and female unemployment and high school diploma counts of every race in one
+    block operation
+
+    Input:
+        df - a pandas dataframe holding the {family}_{race}_m / {family}_{race}_f census columns
+
+    Ouput:
+        A pandas dataframe of {race}_unemp and {race}_hs_dip columns aligned with df
+    """
+    pairs = [(family, race) for family in SEX_SPLIT_FAMILIES for race in RACES
+             if '{}_{}_m'.format(family, race) in df.columns and '{}_{}_f'.format(family, race) in df.columns]
+    male = df[['{}_{}_m'.format(family, race) for family, race in pairs]].to_numpy()
+    female = df[['{}_{}_f'.format(family, race) for family, race in pairs]].to_numpy()
+    # compact_census keeps each count in the narrowest integer type that holds it, which is too
+    # narrow for the sum of the two
+    wide = np.promote_types(np.result_type(male, female), np.int64)
+
+    return pd.DataFrame(
+        male.astype(wide) + female,
+        columns = ['{}_{}'.format(race, family) for family, race in pairs],
+        index = df.index,
     )
+
+
+def aggregate_health_unemp(df):
+    split = ['{}_{}_{}'.format(family, race, sex) for family in SEX_SPLIT_FAMILIES for race in RACES for sex in 'mf']
+    export = pd.concat([df.drop(split, axis = 1, errors = 'ignore'), derive_race_columns(df)], axis = 1)
     
     return export
 
 
-def summary_stat_by_state(dff, var):
-    
+def summary_view(df):
+
     """
-    Generates sample summary statistics for a given demeographic category across all represented races
-    per state
-    
+    Materializes, once per upload, the columns the summary and plotting code reads: the id
+    columns, the census category columns and the per race unemployment and diploma sums
+
     Input:
-        dff - a pandas dataframe
-        var - a string representing a demographic category (Population, Income, Health)
-        
+        df - a merged pandas dataframe
+
     Ouput:
-        A pandas dataframe illustrating summary statistics per state 
+        A pandas dataframe aligned row for row with df
     """
-    dff = aggregate_health_unemp(dff)
-    
-    id_zip = dff[['ID', 'zip', 'STATE']]
-    
-    if var == 'Population':
-        pop_df = dff.filter(like = 'pop')
-        pop_df = pop_df.drop(['tot_pop_all'], axis = 1).copy()
-        population_merge = pd.concat([id_zip, pop_df], axis = 1)
-        population = population_merge.drop(['ID', 'zip'], axis = 1).groupby(['STATE']).mean().reset_index()
-        stats = population.drop('STATE', axis = 1)
-        population['mean'] = stats.mean(axis = 1)
-        population['std'] = stats.std(axis = 1)
-        population['max_race'] = stats.idxmax(axis = 1)
-        population['max'] = stats.max(axis = 1)
-        population['min_race'] = stats.idxmin(axis = 1)
-        population['min'] = stats.min(axis = 1)
-        population['range'] = population['max'] - population['min']
-        d_pop = {
-            'tot_pop_asian': 'asian', 
-            'tot_pop_black': 'black', 
+    columns = ['ID', 'zip', 'STATE'] + [
+        c for spec in SUMMARY_CATEGORIES.values() for c in spec['totals'] + list(spec['races'])] + NR_COLUMNS
+    derived = derive_race_columns(df)
+    columns = [c for c in columns if c in df.columns and c not in derived.columns]
+
+    # the statistics are computed from the values as printed, not their float32 approximations
+    return pd.concat([widen_float32(df[columns]), derived], axis = 1)
+
+
+def stored_view(storage, df):
+    view = session_store.get(storage + '-view')
+    if view is None:
+        view = summary_view(df)
+        session_store.put(view, storage + '-view')
+
+    return view
+
+
+SUMMARY_CATEGORIES = {
+    'Population': {
+        'totals': ['tot_pop_all'],
+        'races': {
             'tot_pop_white': 'white',
+            'tot_pop_black': 'black',
+            'tot_pop_asian': 'asian',
             'tot_pop_native' : 'native',
             'tot_pop_pacif' : 'pacif',
             'tot_pop_other' : 'other'
-        }
-        population['max_race'] = population['max_race'].map(d_pop)
-        population['min_race'] = population['min_race'].map(d_pop)
-        
-        return population.round(2)
-        
-    elif var == 'Income':
-        income_df = dff.filter(like = 'med_fam_inc')
-        income_df = income_df.drop(['med_fam_inc_all'], axis = 1).copy()
-        income_merge = pd.concat([id_zip, income_df], axis = 1)
-        income = income_merge.drop(['ID', 'zip'], axis = 1).groupby(['STATE']).mean().reset_index()
-        stats = income.drop('STATE', axis = 1)
-        income['mean'] = stats.mean(axis = 1)
-        income['std'] = stats.std(axis = 1)
-        income['max_race'] = stats.idxmax(axis = 1)
-        income['max'] = stats.max(axis = 1)
-        income['min_race'] = stats.idxmin(axis = 1)
-        income['min'] = stats.min(axis = 1)
-        income['range'] = income['max'] - income['min']
-        d_inc = {
+        },
+    },
+    'Income': {
+        'totals': ['med_fam_inc_all'],
+        'races': {
             'med_fam_inc_white' : 'white',
             'med_fam_inc_black' : 'black',
             'med_fam_inc_asian' : 'asian',
             'med_fam_inc_native' : 'native',
             'med_fam_inc_pacif' : 'pacif',
             'med_fam_inc_other' : 'other'
-        }
-        income['max_race'] = income['max_race'].map(d_inc)
-        income['min_race'] = income['min_race'].map(d_inc)
-        
-        return income.round(2)
-    
-    elif var == 'Health':
-        health_df = dff.filter(like = 'health')
-        health_df = health_df.drop(['health_ins_all'], axis = 1).copy()
-        health_merge = pd.concat([id_zip, health_df], axis = 1)
-        health = health_merge.drop(['ID', 'zip'], axis = 1).groupby(['STATE']).mean().reset_index()
-        stats = health.drop('STATE', axis = 1)
-        health['mean'] = stats.mean(axis = 1)
-        health['std'] = stats.std(axis = 1)
-        health['max_race'] = stats.idxmax(axis = 1)
-        health['max'] = stats.max(axis = 1)
-        health['min_race'] = stats.idxmin(axis = 1)
-        health['min'] = stats.min(axis = 1)
-        health['range'] = health['max'] - health['min']
-        d_health = {
+        },
+    },
+    'Health': {
+        'totals': ['health_ins_all'],
+        'races': {
             'health_ins_white' : 'white',
             'health_ins_black' : 'black',
             'health_ins_asian' : 'asian',
             'health_ins_native' : 'native',
             'health_ins_pacif' : 'pacif',
             'health_ins_other' : 'other'
-        }
-        health['max_race'] = health['max_race'].map(d_health)
-        health['min_race'] = health['min_race'].map(d_health)
-        
-        return health.round(2)
-    
-    elif var == 'Unemployment':
-        unemp_df = dff.filter(like = 'unemp')
-        unemp_df = unemp_df.drop(['unemp_all_m', 'unemp_all_f'], axis = 1).copy()        
-        unemp_merge = pd.concat([id_zip, unemp_df], axis = 1)
-        unemp = unemp_merge.drop(['ID', 'zip'], axis = 1).groupby(['STATE']).mean().reset_index()
-        stats = unemp.drop('STATE', axis = 1)
-        unemp['mean'] = stats.mean(axis = 1)
-        unemp['std'] = stats.std(axis = 1)
-        unemp['max_race'] = stats.idxmax(axis = 1)
-        unemp['max'] = stats.max(axis = 1)
-        unemp['min_race'] = stats.idxmin(axis = 1)
-        unemp['min'] = stats.min(axis = 1)
-        unemp['range'] = unemp['max'] - unemp['min']
-        d_unemp = {
+        },
+    },
+    'Unemployment': {
+        'totals': ['unemp_all_m', 'unemp_all_f'],
+        'races': {
             'white_unemp' : 'white',
             'black_unemp' : 'black',
             'asian_unemp' : 'asian',
             'native_unemp' : 'native',
             'pacif_unemp' : 'pacif',
             'other_unemp' : 'other'
-        }
-        unemp['max_race'] = unemp['max_race'].map(d_unemp)
-        unemp['min_race'] = unemp['min_race'].map(d_unemp)
-        
-        return unemp.round(2)
-    
-    elif var == 'Education':
-        hs_dip_df = dff.filter(like = 'hs_dip')
-        hs_dip_df = hs_dip_df.drop(['hs_dip_all_m', 'hs_dip_all_f'], axis = 1).copy()  
-        hs_dip_merge = pd.concat([id_zip, hs_dip_df], axis = 1)
-        hs_dip = hs_dip_merge.drop(['ID', 'zip'], axis = 1).groupby(['STATE']).mean().reset_index()
-        stats = hs_dip.drop('STATE', axis = 1)
-        hs_dip['mean'] = stats.mean(axis = 1)
-        hs_dip['std'] = stats.std(axis = 1)
-        hs_dip['max_race'] = stats.idxmax(axis = 1)
-        hs_dip['max'] = stats.max(axis = 1)
-        hs_dip['min_race'] = stats.idxmin(axis = 1)
-        hs_dip['min'] = stats.min(axis = 1)
-        hs_dip['range'] = hs_dip['max'] - hs_dip['min']
-        d_hs_dip = {
+        },
+    },
+    'Education': {
+        'totals': ['hs_dip_all_m', 'hs_dip_all_f'],
+        'races': {
             'white_hs_dip' : 'white',
             'black_hs_dip' : 'black',
             'asian_hs_dip' : 'asian',
             'native_hs_dip' : 'native',
             'pacif_hs_dip' : 'pacif',
             'other_hs_dip' : 'other'
-        }
-        hs_dip['max_race'] = hs_dip['max_race'].map(d_hs_dip)
-        hs_dip['min_race'] = hs_dip['min_race'].map(d_hs_dip)
-        
-        return hs_dip.round(2)
-    
-    else:
-        print('error')
+        },
+    },
+}
 
-        
-def summary_stat_per_sample(dff, var):
+SUMMARY_STATS = ['mean', 'std', 'max_race', 'max', 'min_race', 'min', 'range']
+
+NR_COLUMNS = ['gini_index', 'explicit_black_racial_bias', 'explicit_white_racial_bias', 'implicit_black_white_racial_bias']
+
+STATE_COLUMNS = [c for spec in SUMMARY_CATEGORIES.values() for c in spec['races']] + NR_COLUMNS
+
+
+def category_columns(dff, var):
+
+    """
+    Looks up the columns of a demographic category, raising KeyError when dff lacks any of them
+
+    Ouput:
+        All columns of the category (totals included) and the race columns alone
+    """
+    spec = SUMMARY_CATEGORIES[var]
+    race_columns = list(spec['races'])
+    columns = spec['totals'] + race_columns
+    missing = [c for c in columns if c not in dff.columns]
+    if missing:
+        raise KeyError(missing)
+
+    return columns, race_columns
+
+
+def numeric_block(df, columns):
+    block = np.empty((len(df), len(columns)))
+    for i, c in enumerate(columns):
+        series = df[c]
+        if not pd.api.types.is_numeric_dtype(series):
+            series = pd.to_numeric(series, errors = 'coerce')
+        block[:, i] = series.to_numpy(dtype = float, na_value = np.nan)
+
+    return block
+
+
+class StateAggregates:
+
+    """
+    Per state row counts, sums, value counts and sums of squares of a fixed set of columns over
+    integer coded states. Filters are applied as boolean row masks, so a change to the
+    master_table filter costs one bincount pass over the rows instead of a groupby on a rebuilt
+    dataframe
+    """
+
+    def __init__(self, df, columns):
+        codes, states = pd.factorize(df['STATE'], sort = True)
+        # keep rows grouped by state so every aggregate is a contiguous segment reduction
+        order = np.argsort(codes, kind = 'stable')
+        order = order[codes[order] >= 0]
+        block = numeric_block(df, columns)[order]
+
+        self.columns = list(columns)
+        self.states = np.asarray(states, dtype = object)
+        self._order = order
+        self._codes = codes[order]
+        self._valid = ~np.isnan(block)
+        self._values = np.where(self._valid, block, 0.0)
+
+    @property
+    def nbytes(self):
+        return self._order.nbytes + self._codes.nbytes + self._valid.nbytes + self._values.nbytes + self.states.nbytes
+
+    def totals(self, mask = None):
+
+        """
+        Ouput:
+            Per state row counts and per state, per column sums, value counts and sums of squares
+            over the rows passing mask
+        """
+        codes, values, valid = self._codes, self._values, self._valid
+        if mask is not None:
+            selected = mask[self._order]
+            codes = codes[selected]
+            values = values[selected]
+            valid = valid[selected]
+
+        n_states, n_columns = len(self.states), len(self.columns)
+        rows = np.bincount(codes, minlength = n_states)
+        present = rows > 0
+        starts = (np.cumsum(rows) - rows)[present]
+
+        sums = np.zeros((n_states, n_columns))
+        counts = np.zeros((n_states, n_columns))
+        squares = np.zeros((n_states, n_columns))
+        if present.any():
+            sums[present] = np.add.reduceat(values, starts, axis = 0)
+            counts[present] = np.add.reduceat(valid, starts, axis = 0, dtype = np.int64)
+            squares[present] = np.add.reduceat(values * values, starts, axis = 0)
+
+        return rows, sums, counts, squares
+
+    def moments(self, mask = None):
+
+        """
+        Ouput:
+            Per state means and sample standard deviations as pandas dataframes indexed by STATE,
+            restricted to states with at least one row passing mask
+        """
+        rows, sums, counts, squares = self.totals(mask)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            means = sums / counts
+            variance = (squares - sums * means) / (counts - 1)
+        stds = np.where(counts > 1, np.sqrt(np.maximum(variance, 0.0)), np.nan)
+
+        present = rows > 0
+        index = pd.Index(self.states[present], name = 'STATE')
+
+        return (
+            pd.DataFrame(means[present], index = index, columns = self.columns),
+            pd.DataFrame(stds[present], index = index, columns = self.columns),
+        )
+
+
+def row_statistics(values, columns, races):
+
+    """
+    Nan-aware mean, std, max and min across the columns of a 2d numpy block, with the columns
+    holding the max and min mapped to race labels (NaN for columns that are not a race)
+    """
+    valid = ~np.isnan(values)
+    count = valid.sum(axis = 1)
+    empty = count == 0
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        mean = np.where(valid, values, 0.0).sum(axis = 1) / count
+        squares = np.where(valid, (values - mean[:, None]) ** 2, 0.0).sum(axis = 1)
+        std = np.where(count > 1, np.sqrt(squares / np.maximum(count - 1, 1)), np.nan)
+
+    rows = np.arange(len(values))
+    arg_max = np.where(valid, values, -np.inf).argmax(axis = 1)
+    arg_min = np.where(valid, values, np.inf).argmin(axis = 1)
+    maximum = np.where(empty, np.nan, values[rows, arg_max])
+    minimum = np.where(empty, np.nan, values[rows, arg_min])
+    labels = np.array([races.get(c, np.nan) for c in columns], dtype = object)
+
+    return {
+        'mean': mean,
+        'std': std,
+        'max_race': np.where(empty, np.nan, labels[arg_max]),
+        'max': maximum,
+        'min_race': np.where(empty, np.nan, labels[arg_min]),
+        'min': minimum,
+        'range': maximum - minimum,
+    }
+
+
+def summary_engine(dff, categories, by_state):
+
+    """
+    Generates summary statistics for several demographic categories from a single numeric block.
+    Categories whose columns are missing from dff are left out of the result
+
+    Input:
+        dff - a pandas dataframe
+        categories - a list of keys of SUMMARY_CATEGORIES
+        by_state - True for per state averages, False for per sample statistics
+
+    Ouput:
+        A dict mapping each category to a pandas dataframe of summary statistics
+    """
+    if not any(c in dff.columns for c in DERIVED_COLUMNS):
+        dff = summary_view(dff)
+
+    layout = {}
+    for var in categories:
+        try:
+            layout[var] = category_columns(dff, var)
+        except KeyError:
+            continue
+
+    needed = list(OrderedDict.fromkeys(
+        c for columns, race_columns in layout.values() for c in (race_columns if by_state else columns)))
+
+    if by_state:
+        means, _ = StateAggregates(dff, needed).moments()
+        return {var: category_by_state(means, var) for var in layout}
+
+    position = {c: i for i, c in enumerate(needed)}
+    block = numeric_block(dff, needed)
+    id_zip = dff[['ID', 'zip', 'STATE']]
+
+    export = {}
+    for var, (columns, race_columns) in layout.items():
+        summary = dff[race_columns].copy()
+        stats = row_statistics(block[:, [position[c] for c in columns]], columns, SUMMARY_CATEGORIES[var]['races'])
+        for name in SUMMARY_STATS:
+            summary[name] = stats[name]
+        export[var] = pd.concat([id_zip, summary], axis = 1).round(2)
+
+    return export
+
+
+def category_by_state(means, var):
+
+    """
+    Builds the per state summary of one category from per state column means
+
+    Input:
+        means - a pandas dataframe of column means indexed by STATE (see StateAggregates.moments)
+        var - a key of SUMMARY_CATEGORIES
+
+    Ouput:
+        A pandas dataframe illustrating summary statistics per state
+    """
+    races = SUMMARY_CATEGORIES[var]['races']
+    race_columns = list(races)
+    values = means[race_columns]
+    summary = values.reset_index()
+    stats = row_statistics(values.to_numpy(), race_columns, races)
+    for name in SUMMARY_STATS:
+        summary[name] = stats[name]
+
+    return summary.round(2)
+
+
+def summary_stat_by_state(dff, var):
     
     """
     Generates sample summary statistics for a given demeographic category across all represented races
-    per sample
+    per state
     
     Input:
         dff - a pandas dataframe
         var - a string representing a demographic category (Population, Income, Health)
         
     Ouput:
-        A pandas dataframe illustrating summary statistics per sample
+        A pandas dataframe illustrating summary statistics per state 
     """
-    
-    dff = aggregate_health_unemp(dff)
-    
-    id_zip = dff[['ID', 'zip', 'STATE']]
-    
-    if var == 'Population':
-        pop_df = dff.filter(like = 'pop')
-        population = pop_df.drop(['tot_pop_all'], axis = 1).copy()
-        population['mean'] = pop_df.mean(axis = 1)
-        population['std'] = pop_df.std(axis = 1)
-        population['max_race'] = pop_df.idxmax(axis = 1)
-        population['max'] = pop_df.max(axis = 1)
-        population['min_race'] = pop_df.idxmin(axis = 1)
-        population['min'] = pop_df.min(axis = 1)
-        population['range'] = population['max'] - population['min']
-        d_pop = {
-            'tot_pop_asian': 'asian', 
-            'tot_pop_black': 'black', 
-            'tot_pop_white': 'white',
-            'tot_pop_native' : 'native',
-            'tot_pop_pacif' : 'pacif',
-            'tot_pop_other' : 'other'
-        }
-        population['max_race'] = population['max_race'].map(d_pop)
-        population['min_race'] = population['min_race'].map(d_pop)
-        pop_merge = pd.concat([id_zip, population], axis = 1)
-        
-        return pop_merge.round(2)
-    
-    elif var == 'Income':
-        income_df = dff.filter(like = 'med_fam_inc')
-        income = income_df.drop(['med_fam_inc_all'], axis = 1).copy()
-        income['mean'] = income_df.mean(axis = 1)
-        income['std'] = income_df.std(axis = 1)
-        income['max_race'] = income_df.idxmax(axis = 1)
-        income['max'] = income_df.max(axis = 1)
-        income['min_race'] = income_df.idxmin(axis = 1)
-        income['min'] = income_df.min(axis = 1)
-        income['range'] = income['max'] - income['min']
-        d_inc = {
-            'med_fam_inc_white' : 'white',
-            'med_fam_inc_black' : 'black',
-            'med_fam_inc_asian' : 'asian',
-            'med_fam_inc_native' : 'native',
-            'med_fam_inc_pacif' : 'pacif',
-            'med_fam_inc_other' : 'other'
-        }
-        income['max_race'] = income['max_race'].map(d_inc)
-        income['min_race'] = income['min_race'].map(d_inc)
-        inc_merge = pd.concat([id_zip, income], axis = 1)
-        
-        return inc_merge.round(2)
-    
-    elif var == 'Health':
-        health_df = dff.filter(like = 'health')
-        health = health_df.drop(['health_ins_all'], axis = 1).copy()
-        health['mean'] = health_df.mean(axis = 1)
-        health['std'] = health_df.std(axis = 1)
-        health['max_race'] = health_df.idxmax(axis = 1)
-        health['max'] = health_df.max(axis = 1)
-        health['min_race'] = health_df.idxmin(axis = 1)
-        health['min'] = health_df.min(axis = 1)
-        health['range'] = health['max'] - health['min']
-        d_health = {
-            'health_ins_white' : 'white',
-            'health_ins_black' : 'black',
-            'health_ins_asian' : 'asian',
-            'health_ins_native' : 'native',
-            'health_ins_pacif' : 'pacif',
-            'health_ins_other' : 'other'
-        }
-        health['max_race'] = health['max_race'].map(d_health)
-        health['min_race'] = health['min_race'].map(d_health)
-        health_merge = pd.concat([id_zip, health], axis = 1)   
-        
-        return health_merge.round(2)
-    
-    elif var == 'Unemployment':
-        unemp_df = dff.filter(like = 'unemp')
-        unemp = unemp_df.drop(['unemp_all_m', 'unemp_all_f'], axis = 1).copy()
-        unemp['mean'] = unemp_df.mean(axis = 1)
-        unemp['std'] = unemp_df.std(axis = 1)
-        unemp['max_race'] = unemp_df.idxmax(axis = 1)
-        unemp['max'] = unemp_df.max(axis = 1)
-        unemp['min_race'] = unemp_df.idxmin(axis = 1)
-        unemp['min'] = unemp_df.min(axis = 1)
-        unemp['range'] = unemp['max'] - unemp['min']
-        d_unemp = {
-            'white_unemp' : 'white',
-            'black_unemp' : 'black',
-            'asian_unemp' : 'asian',
-            'native_unemp' : 'native',
-            'pacif_unemp' : 'pacif',
-            'other_unemp' : 'other'
-        }
-        unemp['max_race'] = unemp['max_race'].map(d_unemp)
-        unemp['min_race'] = unemp['min_race'].map(d_unemp)
-        unemp_merge = pd.concat([id_zip, unemp], axis = 1)   
+    if var not in SUMMARY_CATEGORIES:
+        print('error')
+        return None
+
+    return summary_engine(dff, [var], by_state = True)[var]
+
         
-        return unemp_merge.round(2)
+def summary_stat_per_sample(dff, var):
     
-    elif var == 'Education':
-        hs_dip_df = dff.filter(like = 'hs_dip')
-        hs_dip = hs_dip_df.drop(['hs_dip_all_m', 'hs_dip_all_f'], axis = 1).copy()
-        hs_dip['mean'] = hs_dip_df.mean(axis = 1)
-        hs_dip['std'] = hs_dip_df.std(axis = 1)
-        hs_dip['max_race'] = hs_dip_df.idxmax(axis = 1)
-        hs_dip['max'] = hs_dip_df.max(axis = 1)
-        hs_dip['min_race'] = hs_dip_df.idxmin(axis = 1)
-        hs_dip['min'] = hs_dip_df.min(axis = 1)
-        hs_dip['range'] = hs_dip['max'] - hs_dip['min']
-        d_hs_dip = {
-            'white_hs_dip' : 'white',
-            'black_hs_dip' : 'black',
-            'asian_hs_dip' : 'asian',
-            'native_hs_dip' : 'native',
-            'pacif_hs_dip' : 'pacif',
-            'other_hs_dip' : 'other'
-        }
-        hs_dip['max_race'] = hs_dip['max_race'].map(d_hs_dip)
-        hs_dip['min_race'] = hs_dip['min_race'].map(d_hs_dip)
-        hs_dip_merge = pd.concat([id_zip, hs_dip], axis = 1)   
-        
-        return hs_dip_merge.round(2)
+    """
+    Generates sample summary statistics for a given demeographic category across all represented races
+    per sample
     
-    else:
+    Input:
+        dff - a pandas dataframe
+        var - a string representing a demographic category (Population, Income, Health)
+        
+    Ouput:
+        A pandas dataframe illustrating summary statistics per sample
+    """
+    if var not in SUMMARY_CATEGORIES:
         print("input error")
+        return None
+
+    return summary_engine(dff, [var], by_state = False)[var]
+
         
 def summary_stat_by_state_nr(dff):
-    frame = dff[['STATE', 'gini_index', 'explicit_black_racial_bias', 'explicit_white_racial_bias','implicit_black_white_racial_bias']]
-    snr = frame.groupby(['STATE']).mean().reset_index()
+    means, _ = StateAggregates(dff, NR_COLUMNS).moments()
     
+    return nr_by_state(means)
+
+
+def nr_by_state(means):
+    snr = means[[c for c in NR_COLUMNS if c in means.columns]].reset_index()
+
     return snr
 
 
+def state_moments(storage, df, mask, key):
+
+    """
+    Per state means and standard deviations of the filtered rows of an upload. The
+    StateAggregates of the upload are built once; each filter then costs one masked pass
+    """
+    def build():
+        view = stored_view(storage, df)
+        return StateAggregates(view, [c for c in STATE_COLUMNS if c in view.columns])
+
+    aggregates = summary_cache.memoized(('state_aggregates', storage), build)
+
+    return summary_cache.memoized(('state_moments', key), lambda: aggregates.moments(mask))
+
+
+def filtered_stage(storage, filter_query):
+
+    """
+    The computation every view shares per filter change: one filter pass over the upload, the
+    packed row mask and the per state moments, all left in summary_cache under the filtered rows
+    fingerprint
+
+    Ouput:
+        The stage published by the filtered store (the token, the filter, the fingerprint and the
+        number of rows) or None when the token has expired
+    """
+    df, mask, key = filter_rows(storage, filter_query)
+    if df is None:
+        return None
+
+    summary_cache.memoized(('mask', key), lambda: np.packbits(mask))
+    state_moments(storage, df, mask, key)
+
+    return {'storage': storage, 'filter_query': filter_query, 'key': key, 'rows': int(mask.sum())}
+
+
+def stage_rows(stage):
+
+    """
+    Resolves a published stage back to the stored dataframe and its row mask without filtering
+    again; the filter is only re-run if the mask has been evicted from summary_cache
+
+    Ouput:
+        The stored dataframe, a numpy boolean mask and the fingerprint (all None when the stage is
+        empty or the token has expired)
+    """
+    df = session_store.get(stage['storage']) if stage else None
+    if df is None:
+        return None, None, None
+
+    packed = summary_cache.memoized(
+        ('mask', stage['key']), lambda: np.packbits(filter_mask(df, stage['filter_query'])))
+
+    return df, np.unpackbits(packed, count = len(df)).astype(bool), stage['key']
+
+
+HIST_BINS = 50
+HIST_PANELS = [('white', 1, 1), ('black', 1, 2), ('asian', 2, 1), ('native', 2, 2), ('pacific', 3, 1), ('other', 3, 2)]
+
+
+def histogram_bins(values, nbins = HIST_BINS):
+
+    """
+    Bins a column on the server the way plotly autobins go.Histogram(nbinsx=nbins): at most nbins
+    bins of a "nice" width (1, 2, 2.5 or 5 times a power of ten, at least 1 for integer data)
+
+    Ouput:
+        Bin centers, bin counts and the bin width
+    """
+    values = values[~np.isnan(values)]
+    if not len(values):
+        return np.array([]), np.array([], dtype = np.int64), 1.0
+
+    low, high = values.min(), values.max()
+    raw = (high - low) / nbins if high > low else 1.0
+    magnitude = 10.0 ** np.floor(np.log10(raw))
+    size = magnitude * next(m for m in (1, 2, 2.5, 5, 10) if m * magnitude >= raw)
+    if size < 1 and np.all(values == np.floor(values)):
+        size = 1.0
+
+    start = np.floor(low / size) * size
+    edges = start + size * np.arange(int(np.floor((high - start) / size)) + 2)
+    counts, _ = np.histogram(values, bins = edges)
+
+    return edges[:-1] + size / 2, counts, size
+
+
+def sample_histograms(dff, category):
+
+    fig = make_subplots(rows=3, cols=2, subplot_titles=("White", "Black", 'Asian', "Native", "Pacif", "Other"))
+    if category not in SUMMARY_CATEGORIES or not set(SUMMARY_CATEGORIES[category]['races']) <= set(dff.columns):
+        fig.update_layout(title_text = not_merged(category), showlegend = False, height = 1000)
+        return fig
+
+    race_columns = list(SUMMARY_CATEGORIES[category]['races'])
+    block = numeric_block(dff, race_columns)
+    for i, (name, row, col) in enumerate(HIST_PANELS):
+        centers, counts, size = histogram_bins(block[:, i])
+        fig.add_trace(go.Bar(x = centers, y = counts, width = size, name = name), row = row, col = col)
+    fig.update_layout(title_text = category, showlegend = False, height = 1000, bargap = 0)
+        
+    return fig
+
+
+NR_LABELS = {
+    'gini_index': 'Gini Index',
+    'explicit_black_racial_bias': 'Warm-To-Black',
+    'explicit_white_racial_bias': 'Warm-To-White',
+    'implicit_black_white_racial_bias': 'Bias',
+}
+
+
+CATEGORY_OPTIONS = [
+    {'label' : 'Median Family Income', 'value' : 'Income'},
+    {'label' : 'Total Population', 'value' : 'Population'},
+    {'label' : 'Proportion of Residents with Health Insurance Coverage', 'value' : 'Health'},
+    {'label' : 'High School Graduation Rate', 'value' : 'Education'},
+    {'label' : 'Rate of Unemployment', 'value' : 'Unemployment'},
+]
+
+RACE_OPTIONS = [{'label' : race, 'value' : race} for race in ['white', 'black', 'asian', 'native', 'pacif', 'other']]
+
+NR_OPTIONS = [
+    {'label' : 'Gini Index', 'value' : 'gini_index'},
+    {'label' : 'Explicit Feelings of Warmth Towards White People', 'value' : 'explicit_white_racial_bias'},
+    {'label' : 'Explicit Feelings of Warmth Towards Black People', 'value' : 'explicit_black_racial_bias'},
+    {'label' : 'Implicit Black-White Racial Bias', 'value' : 'implicit_black_white_racial_bias'},
+]
+
+
+def merged_groups(columns):
+
+    """
+    The CENSUS_GROUPS families merged into an upload, read off the columns stored with its token
+    """
+    columns = set(columns)
+
+    return [g for g in CENSUS_GROUPS if any(c in columns for c in census_group_columns([g]) if c != 'STATE')]
+
+
+def not_merged(category):
+    label = {o['value']: o['label'] for o in CATEGORY_OPTIONS}.get(category, 'the selected category')
+
+    return 'Not merged with this upload: {}'.format(label)
+
+
+def choropleth_template():
+
+    """
+    Builds the USA-states choropleth both maps are drawn from: the figure px.choropleth produces
+    (scope, geo layout, colour axis and theme) as a plain dict with empty data, built once
+    """
+    fig = px.choropleth(
+        pd.DataFrame({'STATE': [], 'value': []}),
+        locations = 'STATE',
+        color = 'value',
+        hover_name = 'STATE',
+        scope = 'usa',
+        locationmode = 'USA-states',
+    )
+
+    return json.loads(fig.to_json())
+
+
+CHOROPLETH_TEMPLATE = choropleth_template()
+
+
+def map_data(means, category):
+
+    """
+    Packs the per state means both maps colour from into the compact arrays held by the map_data
+    store, so race and variable switches are redrawn in the browser (assets/maps.js)
+
+    Input:
+        means - a pandas dataframe of column means indexed by STATE (see StateAggregates.moments)
+        category - a key of SUMMARY_CATEGORIES
+
+    Ouput:
+        A dict of the states and, per race label and per NR column, the means in the same order.
+        Races and columns that were not merged are left out, and the maps say so
+    """
+    races = SUMMARY_CATEGORIES[category]['races'] if category in SUMMARY_CATEGORIES else {}
+    races = {column: label for column, label in races.items() if column in means.columns}
+    nr_columns = [c for c in NR_COLUMNS if c in means.columns]
+    values = means[list(races) + nr_columns].round(2)
+    values = values.astype(object).where(values.notna(), None)
+
+    return {
+        'states': means.index.tolist(),
+        'races': {label: values[column].tolist() for column, label in races.items()},
+        'nr': {column: values[column].tolist() for column in nr_columns},
+        'labels': NR_LABELS,
+        'note': not_merged(category),
+    }
+
+
 # In[6]:
 
 
@@ -501,6 +2048,23 @@ app.layout = html.Div(
                         'margin': '10px'
                     },
                 ),
+
+                dcc.Checklist(
+                    id = 'select_groups',
+                    options = [{'label' : group, 'value' : group} for group in CENSUS_GROUPS],
+                    value = list(CENSUS_GROUPS),
+                    labelStyle = {'display': 'inline-block', 'margin-right': '15px'},
+                    style = {'textAlign': 'center'},
+                ),
+
+                html.Div(
+                    [
+                        html.Span(id = 'upload-progress'),
+                        dcc.Input(id = 'upload-path', type = 'text', value = '', style = {'display': 'none'}),
+                    ],
+                    id = 'chunked-upload',
+                    style = {'textAlign': 'center'},
+                ),
                 
                 html.P(
                     id = 'prompt',
@@ -523,15 +2087,19 @@ app.layout = html.Div(
                     id = 'master_table',
                     columns = [{'name': i, 'id': i, 'selectable': True, 'hideable': True} for i in vals],
                     data = [],
-                    filter_action = 'native',
-                    sort_action = 'native',
+                    filter_action = 'custom',
+                    filter_query = '',
+                    sort_action = 'custom',
                     sort_mode = 'single',
+                    sort_by = [],
                     column_selectable = 'multi',
                     row_selectable = 'multi',
                     selected_columns = [],
                     selected_rows = [],
-                    page_action = 'native',
+                    page_action = 'custom',
+                    page_current = 0,
                     page_size = 100,
+                    page_count = 0,
                     style_table={"height": "600px", 'overflowY': 'auto'},
                     fixed_rows={'headers': True},
                     style_cell={'minWidth': 100, 'width': 100, 'maxWidth': 100},
@@ -563,7 +2131,7 @@ app.layout = html.Div(
                     'Download Raw Data',
                     id='download-raw-link',
                     download="raw_data.csv",
-                    href="",
+                    href=RAW_DATA_ROUTE,
                     target="_blank"
                 ),
                  
@@ -578,13 +2146,7 @@ app.layout = html.Div(
         [
             dcc.Dropdown(
                 id = 'select_category',
-                options = [
-                    {'label' : 'Median Family Income', 'value' : 'Income'},
-                    {'label' : 'Total Population', 'value' : 'Population'},
-                    {'label' : 'Proportion of Residents with Health Insurance Coverage', 'value' : 'Health'}, 
-                    {'label' : 'High School Graduation Rate', 'value' : 'Education'},
-                    {'label' : 'Rate of Unemployment', 'value' : 'Unemployment'},
-                ],
+                options = CATEGORY_OPTIONS,
                 placeholder = 'Select Category',
                 value = 'Income',
                 style = {
@@ -642,14 +2204,7 @@ app.layout = html.Div(
                         [
                             dcc.Dropdown(
                                 id = 'select_cloro',
-                                options = [
-                                    {'label' : 'white', 'value' : 'white'},
-                                    {'label' : 'black', 'value' : 'black'}, 
-                                    {'label' : 'asian', 'value' : 'asian'},
-                                    {'label' : 'native', 'value' : 'native'},
-                                    {'label' : 'pacif', 'value' : 'pacif'},
-                                    {'label' : 'other', 'value' : 'other'},
-                                ],
+                                options = RACE_OPTIONS,
                                 placeholder = 'Select Category',
                                 value = 'white',
                                 style = {
@@ -693,12 +2248,7 @@ app.layout = html.Div(
                         [
                             dcc.Dropdown(
                                 id = 'select_cloro_nr',
-                                options = [
-                                    {'label' : 'Gini Index', 'value' : 'gini_index'},
-                                    {'label' : 'Explicit Feelings of Warmth Towards White People', 'value' : 'twhite_0to10'},
-                                    {'label' : 'Explicit Feelings of Warmth Towards Black People', 'value' : 'tblack_0to10'},
-                                    {'label' : 'Implicit Black-White Racial Bias', 'value' : 'D_biep.White_Good_all'},
-                                ],
+                                options = NR_OPTIONS,
                                 placeholder = 'Select Category',
                                 value = 'gini_index',
                                 style = {
@@ -734,12 +2284,11 @@ app.layout = html.Div(
                 style={'display': 'none'},
                 children = []
             ),
-
-            html.Div(
-                id='census', 
-                style={'display': 'none'},
-                children = census_master.to_json(date_format='iso', orient='split')
-            ),  
+            dcc.Store(id = 'filtered'),
+            dcc.Store(id = 'merge-job'),
+            dcc.Interval(id = 'merge-poll', interval = STREAM_MERGE_POLL_MS, disabled = True),
+            dcc.Store(id = 'map_data'),
+            dcc.Store(id = 'map_template', data = CHOROPLETH_TEMPLATE),
         ],
         id='hidden-storage'
     ),
@@ -756,54 +2305,178 @@ app.layout = html.Div(
     [
         Output('storage', 'children'),
         Output('prompt', 'children'),
+        Output('merge-job', 'data'),
+        Output('merge-poll', 'disabled'),
     ], 
     [
-        Input('upload-data', 'contents')  
+        Input('upload-data', 'contents'),
+        Input('upload-path', 'value'),
+        Input('merge-poll', 'n_intervals'),
     ],
     [
-        State('upload-data','filename')
+        State('upload-data','filename'),
+        State('select_groups', 'value'),
+        State('merge-job', 'data'),
     ]
 )
 
-def clean_data(contents, filename):
-    if contents is None:
+@instrumented
+def clean_data(contents, upload, polls, filename, groups, job):
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+    if 'merge-poll.n_intervals' in triggered:
+        return merge_job_outcome(job)
+    elif 'upload-path.value' in triggered:
+        path = upload_store.path(upload)
+        if path is None:
+            raise PreventUpdate
+        try:
+            if 'csv' in upload and session_store.spill_dir and estimate_merged_bytes(path, groups) > STREAM_MERGE_BYTES:
+                # too large to merge in memory, or within the request: clean_data polls for it
+                job = {'token': start_stream_merge(path, upload, groups), 'started': time.time()}
+                return dash.no_update, 'merging a large upload, this can take several minutes', job, False
+            raw = read_upload(path, upload)
+        except Exception:
+            prompt = 'unsuccessful load'
+            upload_store.discard(upload)
+            return dash.no_update, prompt, dash.no_update, dash.no_update
+        upload_store.discard(upload)
+    elif contents is None:
         raise PreventUpdate
     else:
         raw = parse_contents(contents, filename)
         
-        try:
-            df = gen_census_data(raw)
-            store = df.to_json(date_format='iso', orient='split')
-            prompt = 'load sucessful'
-            return store, prompt
-        except Exception as e:
-            prompt = 'unsuccessful load'
-            return dash.no_update, prompt
+    try:
+        df, unmatched = parallel_census_merge(raw, groups)
+        record_rows(len(df))
+        store = session_store.put(df)
+        session_store.put(summary_view(df), store + '-view')
+        return store, load_prompt(len(df), unmatched), dash.no_update, dash.no_update
+    except Exception:
+        prompt = 'unsuccessful load'
+        return dash.no_update, prompt, dash.no_update, dash.no_update
+
+
+def merge_job_outcome(job):
+
+    """
+    The clean_data outputs for a poll of a background merge (see start_stream_merge): nothing
+    until it is done, then its token and prompt, with the polling stopped. A merge that has not
+    reported within the session ttl (its worker was restarted) is given up on
+    """
+    outcome = session_store.job(job['token']) if job else None
+    if outcome is None:
+        if job and time.time() - job['started'] <= session_store.ttl:
+            raise PreventUpdate
+        return dash.no_update, 'unsuccessful load', None, True
+    if 'error' in outcome:
+        return dash.no_update, 'unsuccessful load', None, True
+
+    record_rows(outcome['rows'])
+
+    return job['token'], load_prompt(outcome['rows'], outcome['unmatched']), None, True
+
+
+def load_prompt(rows, unmatched):
+    prompt = 'load sucessful'
+    if unmatched:
+        prompt += ' ({} of {} rows have a zip code that could not be matched)'.format(unmatched, rows)
+
+    return prompt
+
+
+@server.route(UPLOAD_ROUTE + '<upload_id>', methods = ['GET', 'POST'])
+def upload_chunk(upload_id):
+    try:
+        if flask.request.method == 'POST':
+            offset, accepted = upload_store.append(
+                upload_id, int(flask.request.args.get('offset', 0)), flask.request.stream,
+                flask.request.content_length or 0)
+        else:
+            offset, accepted = upload_store.offset(upload_id), True
+    except (KeyError, ValueError):
+        flask.abort(400)
+    except OverflowError:
+        flask.abort(413)
+
+    return flask.jsonify(offset = offset), 200 if accepted else 409
+
+
+@server.route(UPLOAD_ROUTE + '<upload_id>/complete', methods = ['POST'])
+def complete_upload(upload_id):
+    try:
+        name = upload_store.complete(upload_id, flask.request.args.get('filename', ''))
+    except KeyError:
+        flask.abort(400)
+    except OSError:
+        flask.abort(404)
+
+    return flask.jsonify(upload = name)
 
 
 # In[8]:
 
 
 @app.callback(
-    [
-        Output(component_id = 'master_table', component_property = 'columns'),
-        Output(component_id = 'master_table', component_property = 'data'),
-    ],
+    Output(component_id = 'master_table', component_property = 'columns'),
     [
         Input(component_id = 'storage', component_property = 'children')
     ]
 )
 
+@instrumented
 def create_master_table(storage):
-    if not storage:
+    df = session_store.get(storage)
+    if df is None:
         raise PreventUpdate
     else:
-        df = pd.read_json(storage, orient='split')
+        record_rows(len(df))
         columns = [{'name': i, 'id': i, 'selectable': True, 'hideable': True} 
                    for i in df.columns]
-        data = df.to_dict('records')
         
-    return columns, data
+    return columns
+
+
+@app.callback(
+    [
+        Output(component_id = 'master_table', component_property = 'data'),
+        Output(component_id = 'master_table', component_property = 'page_count'),
+    ],
+    [
+        Input(component_id = 'filtered', component_property = 'data'),
+        Input(component_id = 'master_table', component_property = 'page_current'),
+        Input(component_id = 'master_table', component_property = 'page_size'),
+        Input(component_id = 'master_table', component_property = 'sort_by'),
+    ]
+)
+
+@instrumented
+def update_master_page(stage, page_current, page_size, sort_by):
+    df, mask, _ = stage_rows(stage)
+    if df is None:
+        raise PreventUpdate
+    else:
+        rows = np.flatnonzero(mask)
+        record_rows(len(rows))
+        order = sort_order(df, rows, sort_by)
+        start = (page_current or 0) * page_size
+        page = df.take(order[start:start + page_size])
+        page_count = max(1, -(-len(order) // page_size))
+
+    return widen_float32(page).to_dict('records'), page_count
+
+
+@app.callback(
+    Output(component_id = 'master_table', component_property = 'page_current'),
+    [
+        Input(component_id = 'storage', component_property = 'children'),
+        Input(component_id = 'master_table', component_property = 'filter_query'),
+    ]
+)
+
+@instrumented
+def reset_master_page(storage, filter_query):
+    # a new upload or filter can have fewer pages than the one being shown
+    return 0
 
 
 # In[9]:
@@ -816,33 +2489,118 @@ def create_master_table(storage):
     ]
 )
 
+@instrumented
 def export_to_csv(storage):
-    df = pd.read_json(storage, orient='split')
-    csv_string = df.to_csv(index=False, encoding='utf-8')
-    csv_string = "data:text/csv;charset=utf-8,%EF%BB%BF" + urllib.parse.quote(csv_string)
-    
-    return csv_string   
+    if not storage:
+        raise PreventUpdate
+
+    return '{}{}?gzip=1'.format(MERGED_DATA_ROUTE, storage)
+
+
+def iter_csv_chunks(df, chunk_rows = EXPORT_CHUNK_ROWS):
+
+    """
+    Generates a csv (with a utf-8 byte order mark) from a dataframe chunk_rows rows at a time so
+    that only one chunk is ever rendered in memory
+    """
+    yield '\ufeff'.encode('utf-8')
+    yield df.iloc[:0].to_csv(index = False).encode('utf-8')
+    for start in range(0, len(df), chunk_rows):
+        yield widen_float32(df.iloc[start:start + chunk_rows]).to_csv(index = False, header = False).encode('utf-8')
+
+
+def gzip_chunks(chunks, level = 6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def iter_file_chunks(path, block_bytes = 2**20):
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_bytes), b''):
+            yield block
+
+
+@server.route(MERGED_DATA_ROUTE + '<token>')
+def download_merged_data(token):
+    path = session_store.file(token)
+    if path is not None:
+        chunks = iter_file_chunks(path)
+    else:
+        df = session_store.get(token)
+        if df is None:
+            flask.abort(404)
+        chunks = iter_csv_chunks(df)
+
+    headers = {'Content-Disposition': 'attachment; filename=merged_data.csv'}
+    if flask.request.args.get('gzip') == '1' and 'gzip' in flask.request.accept_encodings:
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+
+    return flask.Response(chunks, mimetype = 'text/csv', headers = headers)
 
 
 # In[10]:
 
 
+_raw_census_lock = threading.Lock()
+
+
+def raw_census_csv(path = CENSUS_CSV, cache_dir = CACHE_DIR):
+
+    """
+    Writes census_master to a csv in the cache directory once, rewriting it only when
+    master_data.csv is newer than the existing copy
+
+    Ouput:
+        The absolute path of the csv
+    """
+    out_path = os.path.abspath(os.path.join(cache_dir, 'raw_data.csv'))
+    with _raw_census_lock:
+        if not os.path.exists(out_path) or os.path.getmtime(out_path) < os.path.getmtime(path):
+            os.makedirs(cache_dir, exist_ok = True)
+            tmp_path = '{}.{}.tmp'.format(out_path, os.getpid())
+            keys = census_master['zip'].to_numpy()
+            raw = widen_float32(census_master.assign(zip = format_zip(keys, pd.Series('', index = census_master.index))))
+            raw.to_csv(tmp_path, index = False, encoding = 'utf-8-sig')
+            os.replace(tmp_path, out_path)
+
+    return out_path
+
+
+@server.route(RAW_DATA_ROUTE)
+def download_raw_data():
+    return flask.send_file(
+        raw_census_csv(),
+        mimetype = 'text/csv',
+        as_attachment = True,
+        attachment_filename = 'raw_data.csv',
+        conditional = True,
+    )
+
+
+# In[11]:
+
+
 @app.callback(
-    Output(component_id = 'download-raw-link', component_property = 'href'),
+    Output(component_id = 'filtered', component_property = 'data'),
     [
-        Input(component_id = 'census', component_property = 'children')
+        Input(component_id = 'storage', component_property = 'children'),
+        Input(component_id = 'master_table', component_property = 'filter_query'),
     ]
 )
 
-def export_to_csv(census):
-    df = pd.read_json(census, orient='split')
-    csv_string = df.to_csv(index=False, encoding='utf-8')
-    csv_string = "data:text/csv;charset=utf-8,%EF%BB%BF" + urllib.parse.quote(csv_string)
-    
-    return csv_string 
-
+@instrumented
+def update_filtered(storage, filter_query):
+    stage = filtered_stage(storage, filter_query) if storage else None
+    if stage is None:
+        raise PreventUpdate
+    record_rows(stage['rows'])
 
-# In[11]:
+    return stage
 
 
 @app.callback(
@@ -853,257 +2611,192 @@ def export_to_csv(census):
         
     ],
     [
-        Input(component_id = 'master_table', component_property = 'derived_virtual_data'),
+        Input(component_id = 'filtered', component_property = 'data'),
         Input(component_id = 'select_category', component_property = 'value')
     ]
 )
 
-def update_dash_tables(all_row_data, category):
-    if not all_row_data:
+@instrumented
+def update_dash_tables(stage, category):
+    df, mask, key = stage_rows(stage)
+    if df is None or not mask.any():
         raise PreventUpdate
     else:
-        dff = pd.DataFrame(all_row_data)
-
-        summary_by_sample = summary_stat_per_sample(dff, category)
-        summary_by_state = summary_stat_by_state(dff, category)
-        summary_by_state_nr = summary_stat_by_state_nr(dff)
-
-        table_1 = dash_table.DataTable(
-            columns = [{'name': i, 'id': i, 'selectable': True, 'hideable': True} 
-                       for i in summary_by_sample.columns],
-            data = summary_by_sample.to_dict('records'),
-            filter_action = 'native',
-            sort_action = 'native',
-            sort_mode = 'single',
-            column_selectable = 'multi',
-            row_selectable = 'multi',
-            selected_columns = [],
-            selected_rows = [],
-            page_action = 'native',
-            page_size = 100,
-            style_table={'height': '800px', 'maxHeight': '800px', 'overflowY': 'auto'},
-            fixed_rows={'headers': True},
-            style_cell={'minWidth': 100, 'width': 100, 'maxWidth': 100},
-            style_data_conditional=[
-            {
-                'if': {'row_index': 'odd'},
-                'backgroundColor': 'rgb(248, 248, 248)'
-            }
-                ],
-            style_header={
-                'backgroundColor': 'rgb(230, 230, 230)',
-                'fontWeight': 'bold'
-                }
-        )
+        record_rows(mask.sum())
+        view = stored_view(stage['storage'], df)
+        means, _ = state_moments(stage['storage'], df, mask, key)
+        try:
+            summary_by_sample = summary_cache.memoized(
+                ('per_sample', key, category), lambda: summary_stat_per_sample(view[mask], category))
+            summary_by_state = category_by_state(means, category)
+        except KeyError:
+            # the category's columns were not merged (see CENSUS_GROUPS)
+            summary_by_sample = summary_by_state = None
+        summary_by_state_nr = nr_by_state(means)
 
-        table_2 = dash_table.DataTable(
-            columns = [{'name': i, 'id': i, 'selectable': True, 'hideable': True} 
-                       for i in summary_by_state.columns],
-            data = summary_by_state.to_dict('records'),
-            filter_action = 'native',
-            sort_action = 'native',
-            sort_mode = 'single',
-            column_selectable = 'multi',
-            row_selectable = 'multi',
-            selected_columns = [],
-            selected_rows = [],
-            page_action = 'native',
-            page_size = 100,
-            style_table={'height': '500px', 'overflowY': 'auto'},
-            fixed_rows={'headers': True},
-            style_cell={'minWidth': 100, 'width': 100, 'maxWidth': 100},
-            style_data_conditional=[
-            {
-                'if': {'row_index': 'odd'},
-                'backgroundColor': 'rgb(248, 248, 248)'
-            }
-                ],
-            style_header={
-                'backgroundColor': 'rgb(230, 230, 230)',
-                'fontWeight': 'bold'
-                }
-        )
-        
-        table_3 = dash_table.DataTable(
-            columns = [{'name': i, 'id': i, 'selectable': True, 'hideable': True} 
-                       for i in summary_by_state_nr.columns],
-            data = summary_by_state_nr.to_dict('records'),
-            filter_action = 'native',
-            sort_action = 'native',
-            sort_mode = 'single',
-            column_selectable = 'multi',
-            row_selectable = 'multi',
-            selected_columns = [],
-            selected_rows = [],
-            page_action = 'native',
-            page_size = 100,
-            style_table={'height': '500px', 'overflowY': 'auto'},
-            fixed_rows={'headers': True},
-            style_cell={'minWidth': 100, 'width': 100, 'maxWidth': 100},
-            style_data_conditional=[
-            {
-                'if': {'row_index': 'odd'},
-                'backgroundColor': 'rgb(248, 248, 248)'
-            }
-                ],
-            style_header={
-                'backgroundColor': 'rgb(230, 230, 230)',
-                'fontWeight': 'bold'
-                }
-        ) 
-    
+        if summary_by_sample is None:
+            table_1 = table_2 = html.P(not_merged(category))
+        else:
+            table_1 = summary_table(summary_by_sample, {'height': '800px', 'maxHeight': '800px', 'overflowY': 'auto'})
+            table_2 = summary_table(summary_by_state, {'height': '500px', 'overflowY': 'auto'})
+
+        if len(summary_by_state_nr.columns) > 1:
+            table_3 = summary_table(summary_by_state_nr, {'height': '500px', 'overflowY': 'auto'})
+        else:
+            table_3 = html.P('Not merged with this upload: Gini Index and Racial Bias')
 
         return table_1, table_2, table_3
 
 
+def summary_table(summary, style_table):
+    return dash_table.DataTable(
+        columns = [{'name': i, 'id': i, 'selectable': True, 'hideable': True} 
+                   for i in summary.columns],
+        data = summary.to_dict('records'),
+        filter_action = 'native',
+        sort_action = 'native',
+        sort_mode = 'single',
+        column_selectable = 'multi',
+        row_selectable = 'multi',
+        selected_columns = [],
+        selected_rows = [],
+        page_action = 'native',
+        page_size = 100,
+        style_table=style_table,
+        fixed_rows={'headers': True},
+        style_cell={'minWidth': 100, 'width': 100, 'maxWidth': 100},
+        style_data_conditional=[
+        {
+            'if': {'row_index': 'odd'},
+            'backgroundColor': 'rgb(248, 248, 248)'
+        }
+            ],
+        style_header={
+            'backgroundColor': 'rgb(230, 230, 230)',
+            'fontWeight': 'bold'
+            }
+    )
+
+
+@app.callback(
+    [
+        Output(component_id = 'select_category', component_property = 'options'),
+        Output(component_id = 'select_category', component_property = 'value'),
+        Output(component_id = 'select_cloro', component_property = 'options'),
+        Output(component_id = 'select_cloro', component_property = 'value'),
+        Output(component_id = 'select_cloro_nr', component_property = 'options'),
+        Output(component_id = 'select_cloro_nr', component_property = 'value'),
+    ],
+    [
+        Input(component_id = 'storage', component_property = 'children'),
+    ],
+    [
+        State(component_id = 'select_category', component_property = 'value'),
+        State(component_id = 'select_cloro', component_property = 'value'),
+        State(component_id = 'select_cloro_nr', component_property = 'value'),
+    ]
+)
+
+@instrumented
+def update_view_options(storage, category, race, variable):
+
+    """
+    Offers only the categories and NR variables merged into the upload, keeping each selection
+    that is still offered and moving the others to the first option (None when nothing is left)
+    """
+    df = session_store.get(storage) if storage else None
+    if df is None:
+        raise PreventUpdate
+
+    groups = merged_groups(df.columns)
+    categories = [o for o in CATEGORY_OPTIONS if o['value'] in groups]
+    races = RACE_OPTIONS if categories else []
+    variables = [o for o in NR_OPTIONS if o['value'] in df.columns]
+
+    def keep(value, options):
+        values = [o['value'] for o in options]
+        return value if value in values else next(iter(values), None)
+
+    return (
+        categories, keep(category, categories),
+        races, keep(race, races),
+        variables, keep(variable, variables),
+    )
+
+
 # In[12]:
 
 
 @app.callback(
     Output(component_id = 'sum_stat', component_property = 'figure'),
     [
-        Input(component_id = 'master_table', component_property = 'derived_virtual_data'),
+        Input(component_id = 'filtered', component_property = 'data'),
         Input(component_id = 'select_category', component_property = 'value')
     ]
 )
 
 
-def update_hist(all_row_data, category):
-    if not all_row_data :
+@instrumented
+def update_hist(stage, category):
+    df, mask, key = stage_rows(stage)
+    if df is None or not mask.any():
         raise PreventUpdate
     else:
-    
-        dff = pd.DataFrame(all_row_data)
-        dff = aggregate_health_unemp(dff)
-        fig = make_subplots(rows=3, cols=2, subplot_titles=("White", "Black", 'Asian', "Native", "Pacif", "Other"))
-
-        if category == 'Income':
-
-            fig.add_trace(go.Histogram(x = dff['med_fam_inc_white'], nbinsx=50, name = 'white'),row=1, col=1)
-            fig.add_trace(go.Histogram(x = dff['med_fam_inc_black'], nbinsx=50, name = 'black'),row=1, col=2)
-            fig.add_trace(go.Histogram(x = dff['med_fam_inc_asian'], nbinsx=50, name = 'asian'),row=2, col=1)
-            fig.add_trace(go.Histogram(x = dff['med_fam_inc_native'], nbinsx=50, name = 'native'),row=2, col=2)
-            fig.add_trace(go.Histogram(x = dff['med_fam_inc_pacif'], nbinsx=50, name = 'pacific'),row=3, col=1)
-            fig.add_trace(go.Histogram(x = dff['med_fam_inc_other'], nbinsx=50, name = 'other'),row=3, col=2)
-            fig.update_layout(title_text="Income", showlegend=False, height=1000)
-
-        elif category == 'Population':
-
-            fig.add_trace(go.Histogram(x = dff['tot_pop_white'], nbinsx=50, name = 'white'),row=1, col=1)
-            fig.add_trace(go.Histogram(x = dff['tot_pop_black'], nbinsx=50, name = 'black'),row=1, col=2)
-            fig.add_trace(go.Histogram(x = dff['tot_pop_asian'], nbinsx=50, name = 'asian'),row=2, col=1)
-            fig.add_trace(go.Histogram(x = dff['tot_pop_native'], nbinsx=50, name = 'native'),row=2, col=2)
-            fig.add_trace(go.Histogram(x = dff['tot_pop_pacif'], nbinsx=50, name = 'pacific'),row=3, col=1)
-            fig.add_trace(go.Histogram(x = dff['tot_pop_other'], nbinsx=50, name = 'other'),row=3, col=2)
-            fig.update_layout(title_text="Population", showlegend=False, height=1000)
-
-        elif category == 'Health':
-
-            fig.add_trace(go.Histogram(x = dff['health_ins_white'], nbinsx=50, name = 'white'),row=1, col=1)
-            fig.add_trace(go.Histogram(x = dff['health_ins_black'], nbinsx=50, name = 'black'),row=1, col=2)
-            fig.add_trace(go.Histogram(x = dff['health_ins_asian'], nbinsx=50, name = 'asian'),row=2, col=1)
-            fig.add_trace(go.Histogram(x = dff['health_ins_native'], nbinsx=50, name = 'native'),row=2, col=2)
-            fig.add_trace(go.Histogram(x = dff['health_ins_pacif'], nbinsx=50, name = 'pacific'),row=3, col=1)
-            fig.add_trace(go.Histogram(x = dff['health_ins_other'], nbinsx=50, name = 'other'),row=3, col=2)
-            fig.update_layout(title_text="Health", showlegend=False, height=1000)
-
-        elif category == 'Education':
-
-            fig.add_trace(go.Histogram(x = dff['white_hs_dip'], nbinsx=50, name = 'white'),row=1, col=1)
-            fig.add_trace(go.Histogram(x = dff['black_hs_dip'], nbinsx=50, name = 'black'),row=1, col=2)
-            fig.add_trace(go.Histogram(x = dff['asian_hs_dip'], nbinsx=50, name = 'asian'),row=2, col=1)
-            fig.add_trace(go.Histogram(x = dff['native_hs_dip'], nbinsx=50, name = 'native'),row=2, col=2)
-            fig.add_trace(go.Histogram(x = dff['pacif_hs_dip'], nbinsx=50, name = 'pacific'),row=3, col=1)
-            fig.add_trace(go.Histogram(x = dff['other_hs_dip'], nbinsx=50, name = 'other'),row=3, col=2)
-            fig.update_layout(title_text="Education", showlegend=False, height=1000)
-
-        elif category == 'Unemployment':
-
-            fig.add_trace(go.Histogram(x = dff['white_unemp'], nbinsx=50, name = 'white'),row=1, col=1)
-            fig.add_trace(go.Histogram(x = dff['black_unemp'], nbinsx=50, name = 'black'),row=1, col=2)
-            fig.add_trace(go.Histogram(x = dff['asian_unemp'], nbinsx=50, name = 'asian'),row=2, col=1)
-            fig.add_trace(go.Histogram(x = dff['native_unemp'], nbinsx=50, name = 'native'),row=2, col=2)
-            fig.add_trace(go.Histogram(x = dff['pacif_unemp'], nbinsx=50, name = 'pacific'),row=3, col=1)
-            fig.add_trace(go.Histogram(x = dff['other_unemp'], nbinsx=50, name = 'other'),row=3, col=2)
-            fig.update_layout(title_text="Unemployment", showlegend=False, height=1000)
-            
-        return fig
+        record_rows(mask.sum())
+        return summary_cache.memoized(
+            ('hist', key, category), lambda: sample_histograms(stored_view(stage['storage'], df)[mask], category))
 
 
 # In[13]:
 
 
 @app.callback(
-    Output(component_id = 'us_map', component_property = 'figure'),
+    Output(component_id = 'map_data', component_property = 'data'),
     [
-        Input(component_id = 'master_table', component_property = 'derived_virtual_data'),
+        Input(component_id = 'filtered', component_property = 'data'),
         Input(component_id = 'select_category', component_property = 'value'),
-        Input(component_id = 'select_cloro', component_property = 'value'),
     ]
 )
 
-def update_cloro(all_row_data, category, race):
-    if all_row_data is None:
+@instrumented
+def update_map_data(stage, category):
+    df, mask, key = stage_rows(stage)
+    if df is None:
         raise PreventUpdate
     else:
-        try:
-            dff = pd.DataFrame(all_row_data)
-            stat_by_state = summary_stat_by_state(dff, category)
-            fig = px.choropleth(stat_by_state, 
-                                locations="STATE", 
-                                color=stat_by_state.filter(like=race).columns.tolist()[0], 
-                                hover_name="STATE", scope = 'usa', 
-                                locationmode = 'USA-states', 
-                                labels = {stat_by_state.filter(like='white').columns.tolist()[0]: 'white',
-                                          stat_by_state.filter(like='black').columns.tolist()[0]: 'black',
-                                          stat_by_state.filter(like='asian').columns.tolist()[0]: 'asian',
-                                          stat_by_state.filter(like='native').columns.tolist()[0]: 'native',
-                                          stat_by_state.filter(like='pacif').columns.tolist()[0]: 'pacif',
-                                          stat_by_state.filter(like='other').columns.tolist()[0]: 'other'
-                                         })  
-
-            return fig
-        except KeyError:
-            raise PreventUpdate
+        record_rows(mask.sum())
+        means, _ = state_moments(stage['storage'], df, mask, key)
+
+        return map_data(means, category)
 
 
 # In[14]:
 
 
-@app.callback(
+app.clientside_callback(
+    ClientsideFunction(namespace = 'maps', function_name = 'race'),
+    Output(component_id = 'us_map', component_property = 'figure'),
+    [
+        Input(component_id = 'map_data', component_property = 'data'),
+        Input(component_id = 'select_cloro', component_property = 'value'),
+    ],
+    [
+        State(component_id = 'map_template', component_property = 'data'),
+    ]
+)
+
+app.clientside_callback(
+    ClientsideFunction(namespace = 'maps', function_name = 'nr'),
     Output(component_id = 'us_map_nr', component_property = 'figure'),
     [
-        Input(component_id = 'master_table', component_property = 'derived_virtual_data'),
+        Input(component_id = 'map_data', component_property = 'data'),
         Input(component_id = 'select_cloro_nr', component_property = 'value'),
+    ],
+    [
+        State(component_id = 'map_template', component_property = 'data'),
     ]
 )
 
-def update_cloro_nr(all_row_data, category):
-    if all_row_data is None:
-        raise PreventUpdate
-    else:
-        try:
-            dff = pd.DataFrame(all_row_data)
-            stat_by_state = summary_stat_by_state_nr(dff)
-            fig = px.choropleth(
-                stat_by_state,
-                locations="STATE", 
-                color=category, 
-                hover_name="STATE", 
-                scope = 'usa', 
-                locationmode = 'USA-states', 
-                labels = {
-                    'gini_index':'Gini Index',
-                    'tblack_0to10': 'Warm-To-Black',
-                    'twhite_0to10': 'Warm-To-White',
-                    'D_biep.White_Good_all': 'Bias',
-                }
-            )
-                    
-            return fig
-        except KeyError:
-            raise PreventUpdate
-
 
 
 if __name__ == '__main__':
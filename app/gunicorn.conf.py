@@ -0,0 +1,29 @@
+# Production settings for serving the dashboard with gunicorn, from this directory:
+#
+#     gunicorn -c gunicorn.conf.py dashboard:server
+#
+# The app is imported once in the master process and forked into the workers. With CDSC_MMAP on
+# (the default here) census_master is a memory map of the Arrow cache, so the workers share its
+# physical pages and adding workers does not add a copy of the census per worker.
+
+import multiprocessing
+import os
+
+os.environ.setdefault('CDSC_MMAP', '1')
+
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', '8050'))
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+preload_app = True
+# a request never waits on a large merge: those run on a background thread of the worker and the
+# page polls for them (see start_stream_merge), so this only needs to cover the in-memory merges
+timeout = 120
+
+
+def on_starting(server):
+    # preload_app has already imported the app in the master (building or refreshing the census
+    # cache there, so workers never race to rebuild it); only report what was loaded
+    import dashboard
+
+    server.log.info(
+        'census_master: %d rows, %s', len(dashboard.census_master),
+        'memory-mapped' if dashboard.CENSUS_MMAP else 'in memory')
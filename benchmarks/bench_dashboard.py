@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Times the merge, summary and export paths of app/dashboard.py against synthetic data and writes
+the results as json, so runs on two commits can be compared:
+
+    python benchmarks/bench_dashboard.py --out before.json
+    python benchmarks/bench_dashboard.py --out after.json --compare before.json
+
+Everything runs offline in a scratch directory; the real master_data.csv is never touched.
+"""
+
+import argparse
+import base64
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import synthetic
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIZES = [1000, 10000, 100000, 1000000]
+
+
+def import_dashboard(workdir, master):
+
+    """
+    Imports the dashboard against a synthetic census master. The module loads census_master at
+    import, so the scratch directory and its environment must be in place beforehand
+
+    Input:
+        workdir - a scratch directory; master_data.csv, the census cache and the session and
+                  upload spill directories are all created under it
+        master - a census master from synthetic.make_census_master
+    """
+    master.to_csv(os.path.join(workdir, 'master_data.csv'), index = False)
+    os.environ['CDSC_CACHE_DIR'] = os.path.join(workdir, '.cache')
+    os.environ['CDSC_SESSION_DIR'] = os.path.join(workdir, 'sessions')
+    os.environ['CDSC_UPLOAD_DIR'] = os.path.join(workdir, 'uploads')
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.join(ROOT, 'app'))
+
+    import dashboard
+
+    return dashboard
+
+
+def measure(fn, repeat, memory):
+
+    """
+    Runs fn repeat times and keeps the fastest wall time. The peak is taken from one extra run
+    under tracemalloc, since tracing slows numpy and pandas down too much to time them with it
+
+    Ouput:
+        The result of fn, the best time in seconds and the peak traced bytes (None without memory)
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+
+    peak = None
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            fn()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    return result, best, peak
+
+
+def record(results, stage, rows, fn, repeat, memory):
+    result, seconds, peak = measure(fn, repeat, memory)
+    results.append({'stage': stage, 'rows': rows, 'seconds': seconds, 'peak_bytes': peak})
+    print('{:>9} rows  {:<28} {:>9.4f} s{}'.format(
+        rows, stage, seconds, '' if peak is None else '  {:>9.1f} MB'.format(peak / 2**20)))
+
+    return result
+
+
+def consume(chunks):
+    return sum(len(chunk) for chunk in chunks)
+
+
+def bench_size(dashboard, master, rows, workdir, repeat, memory, merge_workers = ()):
+
+    """
+    Times every stage for one synthetic study of the given number of rows
+
+    Ouput:
+        A list of result dicts
+    """
+    study = synthetic.make_study(rows, master)
+    csv_path = os.path.join(workdir, 'study_{}.csv'.format(rows))
+    study.to_csv(csv_path, index = False)
+    with open(csv_path, 'rb') as f:
+        contents = 'data:text/csv;base64,' + base64.b64encode(f.read()).decode('ascii')
+    out_path = os.path.join(workdir, 'merged_{}.csv'.format(rows))
+
+    results = []
+
+    def run(stage, fn):
+        return record(results, stage, rows, fn, repeat, memory)
+
+    run('parse_contents', lambda: dashboard.parse_contents(contents, 'study.csv'))
+    merged, _ = run('gen_census_data', lambda: dashboard.gen_census_data(study))
+    for workers in merge_workers:
+        run('parallel_census_merge_{}'.format(workers),
+            lambda: dashboard.parallel_census_merge(study, workers = workers, min_rows = 0))
+    run('stream_census_merge', lambda: dashboard.stream_census_merge(csv_path, out_path))
+    run('aggregate_health_unemp', lambda: dashboard.aggregate_health_unemp(merged))
+    view = run('summary_view', lambda: dashboard.summary_view(merged))
+    run('summary_stat_per_sample', lambda: [
+        dashboard.summary_stat_per_sample(view, var) for var in dashboard.SUMMARY_CATEGORIES])
+    run('summary_stat_by_state', lambda: [
+        dashboard.summary_stat_by_state(view, var) for var in dashboard.SUMMARY_CATEGORIES])
+    run('summary_stat_by_state_nr', lambda: dashboard.summary_stat_by_state_nr(view))
+    run('export_csv', lambda: consume(dashboard.iter_csv_chunks(merged)))
+    run('export_csv_gzip', lambda: consume(dashboard.gzip_chunks(dashboard.iter_csv_chunks(merged))))
+
+    os.remove(csv_path)
+    os.remove(out_path)
+
+    return results
+
+
+def bench_raw_export(dashboard, repeat, memory):
+    out_path = os.path.join(dashboard.CACHE_DIR, 'raw_data.csv')
+
+    def export():
+        # raw_census_csv only writes the csv when there is no current copy
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        return dashboard.raw_census_csv()
+
+    results = []
+    record(results, 'raw_census_csv', len(dashboard.census_master), export, repeat, memory)
+
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd = ROOT, stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+
+    """
+    Prints the time and peak memory of every stage relative to an earlier results file
+    """
+    with open(baseline_path) as f:
+        baseline = {(r['stage'], r['rows']): r for r in json.load(f)['results']}
+
+    print('\n{:<28} {:>9} {:>10} {:>10}'.format('stage', 'rows', 'time', 'peak'))
+    for r in results:
+        old = baseline.get((r['stage'], r['rows']))
+        if old is None:
+            continue
+        time_ratio = r['seconds'] / old['seconds'] if old['seconds'] else float('nan')
+        peak_ratio = r['peak_bytes'] / old['peak_bytes'] if r['peak_bytes'] and old['peak_bytes'] else float('nan')
+        print('{:<28} {:>9} {:>9.2f}x {:>9.2f}x'.format(r['stage'], r['rows'], time_ratio, peak_ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type = int, nargs = '+', default = SIZES, help = 'study sizes in rows')
+    parser.add_argument('--zips', type = int, default = 33000, help = 'zip codes in the synthetic census master')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'timed runs per stage (the fastest is kept)')
+    parser.add_argument('--merge-workers', type = int, nargs = '*', default = [2, 4],
+                        help = 'thread counts to time parallel_census_merge with (compare with gen_census_data)')
+    parser.add_argument('--no-memory', action = 'store_true', help = 'skip the tracemalloc peak measurements')
+    parser.add_argument('--out', default = 'bench_results.json', help = 'where the json results are written')
+    parser.add_argument('--compare', help = 'an earlier results file to print ratios against')
+    args = parser.parse_args()
+
+    out = os.path.abspath(args.out)
+    baseline = os.path.abspath(args.compare) if args.compare else None
+    memory = not args.no_memory
+
+    with tempfile.TemporaryDirectory(prefix = 'cdsc-bench-') as workdir:
+        master = synthetic.make_census_master(args.zips)
+        dashboard = import_dashboard(workdir, master)
+
+        results = bench_raw_export(dashboard, args.repeat, memory)
+        for rows in args.sizes:
+            results.extend(bench_size(dashboard, master, rows, workdir, args.repeat, memory, args.merge_workers))
+        os.chdir(ROOT)
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'census_zips': args.zips,
+            'repeat': args.repeat,
+            'cpus': os.cpu_count(),
+        },
+        'results': results,
+    }
+    with open(out, 'w') as f:
+        json.dump(report, f, indent = 2)
+    print('\nwrote {}'.format(out))
+
+    if baseline:
+        compare(results, baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Replays concurrent user sessions against the dashboard's callback endpoint and reports throughput
+and p50/p95/p99 latency per callback:
+
+    python benchmarks/load_test.py --users 8 --sessions 3 --rows 10000
+    python benchmarks/load_test.py --server flask --users 4
+    python benchmarks/load_test.py --url http://localhost:8050 --users 16
+
+Unless --url is given, the app is started locally against a synthetic census master in a scratch
+directory, under gunicorn with --workers workers or under the threaded Flask server.
+
+Every session uploads a study and then does what the browser does for a user who looks at the
+results: the callbacks fired by the upload, a filter on one state, a sort and page change, two
+category switches and the gzipped download. Switching the race shown on a map is a clientside
+callback (assets/maps.js) and sends no request, so it is not replayed.
+"""
+
+import argparse
+import base64
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+import numpy as np
+
+import synthetic
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP = os.path.join(ROOT, 'app')
+CATEGORIES = ['Population', 'Income', 'Health', 'Unemployment', 'Education']
+GROUPS = ['Population', 'Income', 'Health', 'Unemployment', 'Education', 'Gini Index', 'Racial Bias']
+CHUNKED_BYTES = 8 * 2**20
+CHUNK_BYTES = 4 * 2**20
+POLL_SECONDS = 2
+SERVE_FLASK = 'import sys, dashboard; dashboard.server.run(port = int(sys.argv[1]), threaded = True)'
+
+
+class Recorder:
+
+    """
+    Collects the latency of every request by name from all simulated users
+    """
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, ok):
+        with self._lock:
+            self.latencies.setdefault(name, []).append(seconds)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self, elapsed, sessions):
+
+        """
+        Ouput:
+            A dict with the overall throughput and, per request name, the count, errors and
+            latency percentiles in milliseconds
+        """
+        requests = sum(len(v) for v in self.latencies.values())
+        callbacks = {}
+        for name, latencies in self.latencies.items():
+            ms = np.array(latencies) * 1000
+            callbacks[name] = {
+                'requests': len(ms),
+                'errors': self.errors.get(name, 0),
+                'mean_ms': float(ms.mean()),
+                'p50_ms': float(np.percentile(ms, 50)),
+                'p95_ms': float(np.percentile(ms, 95)),
+                'p99_ms': float(np.percentile(ms, 99)),
+            }
+
+        return {
+            'elapsed_s': elapsed,
+            'sessions': sessions,
+            'requests': requests,
+            'requests_per_s': requests / elapsed,
+            'sessions_per_s': sessions / elapsed,
+            'callbacks': callbacks,
+        }
+
+
+class Session:
+
+    """
+    One simulated browser. Requests go through timed(), which records the latency under the
+    callback name; a 204 (PreventUpdate) is a success with no update
+    """
+
+    def __init__(self, base_url, recorder, rng, think, timeout):
+        self.base_url = base_url
+        self.recorder = recorder
+        self.rng = rng
+        self.think = think
+        self.timeout = timeout
+
+    def timed(self, name, request):
+        start = time.perf_counter()
+        ok = False
+        try:
+            with urllib.request.urlopen(request, timeout = self.timeout) as response:
+                body = response.read()
+                status = response.status
+            ok = True
+        finally:
+            self.recorder.add(name, time.perf_counter() - start, ok)
+        if self.think:
+            time.sleep(self.rng.uniform(0, self.think))
+
+        return status, body
+
+    def callback(self, name, outputs, inputs, state = (), changed = None):
+
+        """
+        Posts one callback to /_dash-update-component the way the Dash renderer does
+
+        Input:
+            name - the callback name results are recorded under
+            outputs - a list of (id, property) pairs
+            inputs, state - lists of (id, property, value) triples
+            changed - the 'id.property' that triggered the callback, the first input by default
+
+        Ouput:
+            A dict of the returned outputs keyed by id, empty after a PreventUpdate
+        """
+        specs = [{'id': i, 'property': p} for i, p in outputs]
+        if len(outputs) == 1:
+            output, specs = '{}.{}'.format(*outputs[0]), specs[0]
+        else:
+            output = '..' + '...'.join('{}.{}'.format(i, p) for i, p in outputs) + '..'
+        body = {
+            'output': output,
+            'outputs': specs,
+            'inputs': [{'id': i, 'property': p, 'value': v} for i, p, v in inputs],
+            'state': [{'id': i, 'property': p, 'value': v} for i, p, v in state],
+            'changedPropIds': [changed or '{}.{}'.format(*inputs[0][:2])],
+        }
+        request = urllib.request.Request(
+            self.base_url + '/_dash-update-component',
+            data = json.dumps(body).encode('utf-8'),
+            headers = {'Content-Type': 'application/json'},
+        )
+        status, data = self.timed(name, request)
+
+        return json.loads(data)['response'] if status == 200 else {}
+
+    def upload(self, study, filename):
+
+        """
+        Sends a study the way the page does: inline through dcc.Upload, or in chunks to the
+        upload route (see assets/upload.js) when it is over 8 MB
+
+        Ouput:
+            The storage token, or None if the merge failed
+        """
+        contents, path = None, ''
+        if len(study) > CHUNKED_BYTES:
+            upload_id = uuid.uuid4().hex
+            offset = 0
+            while offset < len(study):
+                request = urllib.request.Request(
+                    '{}/upload/{}?offset={}'.format(self.base_url, upload_id, offset),
+                    data = study[offset:offset + CHUNK_BYTES], method = 'POST')
+                _, data = self.timed('upload_chunk', request)
+                offset = json.loads(data)['offset']
+            request = urllib.request.Request(
+                '{}/upload/{}/complete?filename={}'.format(self.base_url, upload_id, filename), data = b'')
+            _, data = self.timed('complete_upload', request)
+            path = json.loads(data)['upload']
+        else:
+            contents = 'data:text/csv;base64,' + base64.b64encode(study).decode('ascii')
+
+        outputs = [('storage', 'children'), ('prompt', 'children'), ('merge-job', 'data'), ('merge-poll', 'disabled')]
+        response = self.callback(
+            'clean_data',
+            outputs,
+            [('upload-data', 'contents', contents), ('upload-path', 'value', path), ('merge-poll', 'n_intervals', None)],
+            [('upload-data', 'filename', filename), ('select_groups', 'value', GROUPS), ('merge-job', 'data', None)],
+            # after a chunked upload it is the hidden upload-path input that changed
+            changed = 'upload-path.value' if path else None,
+        )
+
+        # a merge too large for memory runs in the background; poll for it like the merge-poll interval
+        job, polls = response.get('merge-job', {}).get('data'), 0
+        while job and 'storage' not in response:
+            time.sleep(POLL_SECONDS)
+            polls += 1
+            response = self.callback(
+                'clean_data',
+                outputs,
+                [('upload-data', 'contents', None), ('upload-path', 'value', path), ('merge-poll', 'n_intervals', polls)],
+                [('upload-data', 'filename', filename), ('select_groups', 'value', GROUPS), ('merge-job', 'data', job)],
+                changed = 'merge-poll.n_intervals',
+            )
+            if response.get('merge-poll', {}).get('disabled'):
+                break
+
+        return response.get('storage', {}).get('children')
+
+    def views(self, stage, category, page = 0, sort_by = ()):
+        self.callback(
+            'update_master_page',
+            [('master_table', 'data'), ('master_table', 'page_count')],
+            [('filtered', 'data', stage), ('master_table', 'page_current', page),
+             ('master_table', 'page_size', 100), ('master_table', 'sort_by', list(sort_by))],
+        )
+        self.category(stage, category)
+
+    def category(self, stage, category):
+        self.callback(
+            'update_dash_tables',
+            [('summary_by_sample', 'children'), ('summary_by_state', 'children'), ('summary_by_state_nr', 'children')],
+            [('filtered', 'data', stage), ('select_category', 'value', category)],
+        )
+        self.callback('update_hist', [('sum_stat', 'figure')], [('filtered', 'data', stage), ('select_category', 'value', category)])
+        self.callback('update_map_data', [('map_data', 'data')], [('filtered', 'data', stage), ('select_category', 'value', category)])
+
+    def filter(self, storage, filter_query):
+        response = self.callback(
+            'update_filtered',
+            [('filtered', 'data')],
+            [('storage', 'children', storage), ('master_table', 'filter_query', filter_query)],
+        )
+
+        return response.get('filtered', {}).get('data')
+
+    def run(self, study, states):
+        storage = self.upload(study, 'study.csv')
+        if storage is None:
+            return False
+
+        self.callback('create_master_table', [('master_table', 'columns')], [('storage', 'children', storage)])
+        self.callback('export_to_csv', [('download-merge-link', 'href')], [('storage', 'children', storage)])
+        stage = self.filter(storage, '')
+        self.views(stage, 'Income')
+
+        stage = self.filter(storage, '{{STATE}} = {}'.format(self.rng.choice(states)))
+        self.views(stage, 'Income', page = 1, sort_by = [{'column_id': 'tot_pop_all', 'direction': 'desc'}])
+        for category in self.rng.sample([c for c in CATEGORIES if c != 'Income'], 2):
+            self.category(stage, category)
+
+        request = urllib.request.Request(
+            '{}/download/merged/{}?gzip=1'.format(self.base_url, storage), headers = {'Accept-Encoding': 'gzip'})
+        self.timed('download_merged_data', request)
+
+        return True
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(workdir, server, workers, port):
+
+    """
+    Starts the app in a subprocess against the master_data.csv in workdir
+
+    Ouput:
+        The subprocess.Popen of the server
+    """
+    env = dict(os.environ)
+    env.update({
+        'PYTHONPATH': APP,
+        'CDSC_CACHE_DIR': os.path.join(workdir, '.cache'),
+        'CDSC_SESSION_DIR': os.path.join(workdir, 'sessions'),
+        'CDSC_UPLOAD_DIR': os.path.join(workdir, 'uploads'),
+        'PORT': str(port),
+        'WEB_CONCURRENCY': str(workers),
+    })
+    if server == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', '-c', os.path.join(APP, 'gunicorn.conf.py'), 'dashboard:server']
+    else:
+        command = [sys.executable, '-c', SERVE_FLASK, str(port)]
+    log = open(os.path.join(workdir, 'server.log'), 'wb')
+
+    return subprocess.Popen(command, cwd = workdir, env = env, stdout = log, stderr = subprocess.STDOUT)
+
+
+def wait_until_up(base_url, process = None, timeout = 300):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError('the server exited with status {}'.format(process.returncode))
+        try:
+            with urllib.request.urlopen(base_url + '/_dash-layout', timeout = 5):
+                return
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.5)
+    raise RuntimeError('the server did not come up within {} s'.format(timeout))
+
+
+def run_load(base_url, studies, states, users, sessions, think, timeout, seed):
+
+    """
+    Runs users threads, each replaying sessions sessions back to back
+
+    Ouput:
+        The Recorder report
+    """
+    recorder = Recorder()
+    completed = []
+
+    def user(number):
+        rng = random.Random(seed + number)
+        for i in range(sessions):
+            session = Session(base_url, recorder, rng, think, timeout)
+            try:
+                if session.run(studies[(number + i) % len(studies)], states):
+                    completed.append(number)
+            except (urllib.error.URLError, OSError, ValueError) as e:
+                print('user {}: session failed: {}'.format(number, e))
+
+    threads = [threading.Thread(target = user, args = (n,)) for n in range(users)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return recorder.report(time.perf_counter() - start, len(completed))
+
+
+def print_report(report):
+    print('\n{:<24} {:>8} {:>7} {:>10} {:>10} {:>10} {:>10}'.format(
+        'callback', 'requests', 'errors', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for name, r in sorted(report['callbacks'].items(), key = lambda item: -item[1]['p95_ms']):
+        print('{:<24} {:>8} {:>7} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+            name, r['requests'], r['errors'], r['mean_ms'], r['p50_ms'], r['p95_ms'], r['p99_ms']))
+    print('\n{} sessions, {} requests in {:.1f} s: {:.2f} requests/s, {:.3f} sessions/s'.format(
+        report['sessions'], report['requests'], report['elapsed_s'], report['requests_per_s'], report['sessions_per_s']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type = int, default = 4, help = 'concurrent simulated users')
+    parser.add_argument('--sessions', type = int, default = 2, help = 'sessions each user runs back to back')
+    parser.add_argument('--rows', type = int, default = 10000, help = 'rows per uploaded study')
+    parser.add_argument('--think', type = float, default = 0, help = 'up to this many seconds of think time after each request')
+    parser.add_argument('--url', help = 'an already running app to test instead of starting one')
+    parser.add_argument('--server', choices = ['gunicorn', 'flask'], default = 'gunicorn', help = 'how the app is started')
+    parser.add_argument('--workers', type = int, default = 2, help = 'gunicorn workers')
+    parser.add_argument('--zips', type = int, default = 33000, help = 'zip codes in the synthetic census master')
+    parser.add_argument('--timeout', type = float, default = 300, help = 'seconds before a request counts as failed')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--out', help = 'where the json report is written')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix = 'cdsc-load-') as workdir:
+        master = synthetic.make_census_master(args.zips)
+        # a few distinct studies, so the summary cache is not hit by every user alike
+        studies = [
+            synthetic.make_study(args.rows, master, seed = args.seed + i).to_csv(index = False).encode('utf-8')
+            for i in range(min(args.users, 4))
+        ]
+        states = sorted(master['STATE'].unique())
+
+        process = None
+        base_url = args.url.rstrip('/') if args.url else None
+        if base_url is None:
+            master.to_csv(os.path.join(workdir, 'master_data.csv'), index = False)
+            port = free_port()
+            base_url = 'http://127.0.0.1:{}'.format(port)
+            process = start_server(workdir, args.server, args.workers, port)
+        try:
+            wait_until_up(base_url, process)
+            report = run_load(base_url, studies, states, args.users, args.sessions, args.think, args.timeout, args.seed)
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+
+    report['config'] = {k: v for k, v in vars(args).items() if k != 'out'}
+    print_report(report)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent = 2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Synthetic stand-ins for master_data.csv and for study uploads, so the benchmarks and the load test
+run offline at any scale
+"""
+
+import numpy as np
+import pandas as pd
+
+
+RACES = ['all', 'white', 'black', 'asian', 'native', 'pacif', 'other']
+STATES = [
+    'AK', 'AL', 'AR', 'AZ', 'CA', 'CO', 'CT', 'DC', 'DE', 'FL', 'GA', 'HI', 'IA', 'ID', 'IL', 'IN', 'KS',
+    'KY', 'LA', 'MA', 'MD', 'ME', 'MI', 'MN', 'MO', 'MS', 'MT', 'NC', 'ND', 'NE', 'NH', 'NJ', 'NM', 'NV',
+    'NY', 'OH', 'OK', 'OR', 'PA', 'RI', 'SC', 'SD', 'TN', 'TX', 'UT', 'VA', 'VT', 'WA', 'WI', 'WV', 'WY',
+]
+
+
+def make_census_master(n_zips = 33000, seed = 0):
+
+    """
+    Generates a census master with the columns of master_data.csv
+
+    Input:
+        n_zips - number of zip codes (the real master has about 33000)
+        seed - random seed
+
+    Ouput:
+        A pandas dataframe: zero padded zip strings, STATE (contiguous zip ranges per state), integer
+        counts, incomes with missing values, 4 decimal rates and the Project Implicit scores
+    """
+    rng = np.random.default_rng(seed)
+    zips = np.sort(rng.choice(np.arange(501, 99951), n_zips, replace = False))
+    population = rng.lognormal(8, 1.2, n_zips)
+
+    data = {
+        'zip': pd.Series(zips).astype(str).str.zfill(5),
+        'STATE': np.array(STATES)[zips * len(STATES) // 100000],
+    }
+    shares = rng.dirichlet(np.ones(len(RACES) - 1), n_zips)
+    data['tot_pop_all'] = population.astype(np.int64)
+    for i, race in enumerate(RACES[1:]):
+        data['tot_pop_' + race] = (population * shares[:, i]).astype(np.int64)
+    for race in RACES:
+        income = rng.normal(70000, 25000, n_zips).clip(10000).round()
+        data['med_fam_inc_' + race] = np.where(rng.random(n_zips) < 0.15, np.nan, income)
+    for race in RACES:
+        data['health_ins_' + race] = np.where(rng.random(n_zips) < 0.05, np.nan, rng.random(n_zips).round(4))
+    # about one zip in a hundred gets counts just under the int16 limit, so that the male plus
+    # female sums overflow if they are added in the type compact_census stores the counts in
+    near_limit = rng.random(n_zips) < 0.01
+    for family in ['unemp', 'hs_dip']:
+        for race in RACES:
+            for sex in 'mf':
+                counts = rng.poisson(population / 40)
+                data['{}_{}_{}'.format(family, race, sex)] = np.where(near_limit, rng.integers(16384, 32768, n_zips), counts)
+    data['gini_index'] = rng.beta(8, 10, n_zips).round(4)
+    data['explicit_black_racial_bias'] = rng.normal(0, 1, n_zips)
+    data['explicit_white_racial_bias'] = rng.normal(0, 1, n_zips)
+    data['implicit_black_white_racial_bias'] = rng.normal(0.3, 0.4, n_zips)
+
+    return pd.DataFrame(data)
+
+
+def make_study(n_rows, master, waves = 4, seed = 1):
+
+    """
+    Generates a longitudinal study upload against a census master
+
+    Input:
+        n_rows - number of rows
+        master - a census master from make_census_master
+        waves - rows per participant; the same ID and (mostly) the same zip repeat across waves
+        seed - random seed
+
+    Ouput:
+        A pandas dataframe with ID, wave, Zip.Code and two measures. Participants are drawn
+        towards populous zips; Zip.Code is formatted the way real exports are (mostly five digits,
+        some ZIP+4, Excel floats without the leading zero, blanks and zips the master lacks)
+    """
+    rng = np.random.default_rng(seed)
+    n_ids = max(1, n_rows // waves)
+    weights = master['tot_pop_all'].to_numpy(dtype = float) ** 1.5
+    homes = rng.choice(master['zip'].to_numpy(), n_ids, p = weights / weights.sum())
+
+    ids = np.arange(n_rows) % n_ids
+    zips = homes[ids].astype(object)
+    moved = rng.random(n_rows) < 0.1
+    zips[moved] = rng.choice(master['zip'].to_numpy(), moved.sum())
+
+    style = rng.random(n_rows)
+    plus4 = style < 0.03
+    zips[plus4] = [z + '-' + '{:04d}'.format(rng.integers(10000)) for z in zips[plus4]]
+    excel = (style >= 0.03) & (style < 0.05)
+    zips[excel] = [str(int(z)) + '.0' for z in zips[excel]]
+    zips[(style >= 0.05) & (style < 0.06)] = np.nan
+    zips[(style >= 0.06) & (style < 0.065)] = '99999'
+
+    return pd.DataFrame({
+        'ID': ids + 1,
+        'wave': np.arange(n_rows) // n_ids + 1,
+        'Zip.Code': zips,
+        'age': rng.integers(5, 13, n_rows),
+        'bias_score': np.where(rng.random(n_rows) < 0.05, np.nan, rng.normal(0, 1, n_rows).round(3)),
+    })